@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
+from annoying.fields import JSONField
 from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.paginator import Page, Paginator
+from django.db import connections, models
+from django.db.models import Q
+from picklefield.fields import PickledObjectField
 
 admin.ModelAdmin.save_on_top = True
 admin.ModelAdmin.list_per_page = 50
@@ -9,19 +18,161 @@ class GenericRelationListFilter(admin.SimpleListFilter):
     ct_field_name = ''
     id_field_name = ''
     field_name = ''
+    lookups_limit = None
+    lookups_cache_timeout = None
 
     @property
     def parameter_name(self):
         return self.field_name
 
     def lookups(self, request, model_admin):
-        return [('%s%s%s' % (getattr(instance, self.ct_field_name).id, self.separator, getattr(instance, self.id_field_name)), getattr(instance, self.field_name)) for instance in model_admin.model.objects.order_by().distinct(self.ct_field_name,self.id_field_name)]
+        '''
+        Distinct pairs of content type and id are selected by one query and generic objects are fetched
+        by one query for each content type. Lookups could be limited by `lookups_limit`
+        and cached for `lookups_cache_timeout` seconds
+        '''
+        cache_key = 'odnoklassniki_api.admin.lookups.%s.%s' % (model_admin.model._meta.db_table, self.field_name)
+        if self.lookups_cache_timeout:
+            lookups = cache.get(cache_key)
+            if lookups is not None:
+                return lookups
+
+        ct_field_attname = model_admin.model._meta.get_field(self.ct_field_name).attname
+        pairs = model_admin.model.objects.order_by().values_list(ct_field_attname, self.id_field_name).distinct()
+        if self.lookups_limit:
+            pairs = pairs[:self.lookups_limit]
+        pairs = list(pairs)
+
+        ids_by_content_type = {}
+        for content_type_id, id in pairs:
+            ids_by_content_type.setdefault(content_type_id, []).append(id)
+
+        objects = {}
+        for content_type_id, ids in ids_by_content_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            for id, instance in model._default_manager.in_bulk(ids).items():
+                objects[(content_type_id, id)] = instance
+
+        lookups = [('%s%s%s' % (content_type_id, self.separator, id), unicode(objects.get((content_type_id, id), id)))
+                   for content_type_id, id in pairs]
+
+        if self.lookups_cache_timeout:
+            cache.set(cache_key, lookups, self.lookups_cache_timeout)
+        return lookups
 
     def queryset(self, request, queryset):
         if self.value() and self.separator in self.value():
             content_type, id = self.value().split(self.separator)
             return queryset.filter(**{self.ct_field_name: content_type, self.id_field_name: id})
 
+class EstimatedCountPaginator(Paginator):
+
+    '''
+    Paginator for very large tables:
+     * number of objects in unfiltered table on PostgreSQL is taken from planner statistics,
+       if it's bigger than `estimate_threshold`;
+     * page after already visited one is selected by keyset condition on ordering by pk or fetched and pk
+       instead of OFFSET, last key of each page is kept in cache for query with it's filters for short time,
+       so boundaries of pages are not shifted much by changes of data.
+    '''
+    estimate_threshold = 100000
+    keyset_cache_timeout = 60
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = self.get_estimated_count()
+        if self._count is None:
+            self._count = super(EstimatedCountPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
+
+    def get_estimated_count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return None
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] >= self.estimate_threshold:
+            return int(row[0])
+        return None
+
+    def get_keyset_fields(self):
+        '''
+        Return ordering fields suitable for keyset pagination or None
+        '''
+        queryset = self.object_list
+        pk_name = queryset.model._meta.pk.name
+        ordering = [field[:-len(pk_name)] + 'pk' if field.lstrip('-') == pk_name else field
+                    for field in queryset.query.order_by]
+        if ordering in (['pk'], ['-pk']):
+            return ordering
+        # NULLs of fetched are placed in DESC order before other values on PostgreSQL only
+        if ordering == ['-fetched', '-pk'] and connections[queryset.db].vendor == 'postgresql':
+            return ordering
+        return None
+
+    def get_keyset_cache_key(self, fields, number):
+        query = hashlib.md5(str(self.object_list.query)).hexdigest()
+        return 'odnoklassniki_api.admin.keyset.%s.%s.%s.%d' % (self.object_list.model._meta.db_table, query,
+                                                               self.per_page, number)
+
+    def get_keyset_condition(self, fields, key):
+        if fields == ['pk']:
+            return Q(pk__gt=key[0])
+        elif fields == ['-pk']:
+            return Q(pk__lt=key[0])
+        else:
+            return Q(fetched__lt=key[0]) | Q(fetched=key[0], pk__lt=key[1])
+
+    def page(self, number):
+        number = self.validate_number(number)
+        fields = self.get_keyset_fields()
+        key = cache.get(self.get_keyset_cache_key(fields, number - 1)) if fields and number > 1 else None
+
+        if key and None not in key:
+            object_list = self.object_list.filter(self.get_keyset_condition(fields, key))[:self.per_page]
+        else:
+            bottom = (number - 1) * self.per_page
+            object_list = self.object_list[bottom:bottom + self.per_page]
+        object_list = list(object_list)
+
+        if fields and object_list:
+            key = [getattr(object_list[-1], field.lstrip('-')) for field in fields]
+            cache.set(self.get_keyset_cache_key(fields, number), key, self.keyset_cache_timeout)
+
+        return Page(object_list, number, self)
+
+
+class FastChangeListMixin(object):
+
+    '''
+    Admin mixin for changelists of very large tables: estimated count of objects, keyset pagination
+    and deferred loading of text, JSON and pickled fields, that are not displayed in the list
+    '''
+    paginator = EstimatedCountPaginator
+    list_deferred_field_classes = (models.TextField, JSONField, PickledObjectField)
+
+    def get_list_deferred_fields(self, request):
+        list_display = self.get_list_display(request)
+        return [field.name for field in self.model._meta.fields
+                if isinstance(field, self.list_deferred_field_classes) and field.name not in list_display]
+
+    def changelist_view(self, request, extra_context=None):
+        request.odnoklassniki_changelist = True
+        return super(FastChangeListMixin, self).changelist_view(request, extra_context)
+
+    def get_queryset(self, request):
+        parent = super(FastChangeListMixin, self)
+        # Django < 1.6
+        queryset = parent.get_queryset(request) if hasattr(parent, 'get_queryset') else parent.queryset(request)
+        if getattr(request, 'odnoklassniki_changelist', False):
+            queryset = queryset.defer(*self.get_list_deferred_fields(request))
+        return queryset
+    queryset = get_queryset
+
+
 class OdnoklassnikiModelAdmin(admin.ModelAdmin):
 
     def ok_link(self, obj):
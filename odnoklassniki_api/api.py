@@ -1,41 +1,188 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+
 from django.conf import settings
 from social_api.api import ApiAbstractBase, Singleton
-from odnoklassniki import api, OdnoklassnikiError
+from odnoklassniki import OdnoklassnikiError
 from simplejson.decoder import JSONDecodeError
 
-__all__ = ['api_call', 'OdnoklassnikiError']
+from .resilience import CircuitBreaker, LatencyTracker, hedged_call, is_failing_on_overload
+from .scheduler import PriorityRateLimiter, api_priority, get_api_budget, get_api_priority
+from .singleflight import CacheSingleFlight, SingleFlight
+
+__all__ = ['api_call', 'OdnoklassnikiError', 'OdnoklassnikiDeadlineError', 'OdnoklassnikiCircuitOpenError']
 
 APPLICATION_PUBLIC = getattr(settings, 'OAUTH_TOKENS_ODNOKLASSNIKI_CLIENT_PUBLIC', '')
 APPLICATION_SECRET = getattr(settings, 'OAUTH_TOKENS_ODNOKLASSNIKI_CLIENT_SECRET', '')
 
 
+class OdnoklassnikiDeadlineError(OdnoklassnikiError):
+    """
+    Deadline of call is exceeded, while it's repeated after errors
+    """
+
+
+class OdnoklassnikiCircuitOpenError(OdnoklassnikiError):
+    """
+    Calls of method fail fast after persistent errors of server
+    """
+
+
+class ThreadSafeSingleton(Singleton):
+    """
+    Singleton metaclass, that creates only one instance even if it's called from many threads at once
+    """
+    lock = threading.Lock()
+
+    def __call__(cls, *args, **kwargs):
+        if cls.instance is None:
+            with cls.lock:
+                return super(ThreadSafeSingleton, cls).__call__(*args, **kwargs)
+        return cls.instance
+
+
+class ThreadLocalAttribute(object):
+    """
+    Descriptor of attribute with separate value for each thread
+    """
+    def __init__(self, name, default=lambda: None):
+        self.name = name
+        self.default = default
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        local = instance.local
+        if not hasattr(local, self.name):
+            setattr(local, self.name, self.default())
+        return getattr(local, self.name)
+
+    def __set__(self, instance, value):
+        setattr(instance.local, self.name, value)
+
+
 class OdnoklassnikiApi(ApiAbstractBase):
 
-    __metaclass__ = Singleton
+    __metaclass__ = ThreadSafeSingleton
 
     provider = 'odnoklassniki'
     error_class = OdnoklassnikiError
     error_class_repeat = tuple(list(ApiAbstractBase.error_class_repeat) + [JSONDecodeError])
 
+    # state of current call is isolated in thread, tokens storages and transport are shared by all threads
+    method = ThreadLocalAttribute('method')
+    api = ThreadLocalAttribute('api')
+    tokens = ThreadLocalAttribute('tokens', list)
+    used_access_tokens = ThreadLocalAttribute('used_access_tokens', list)
+    consistent_token = ThreadLocalAttribute('consistent_token')
+    recursion_count = ThreadLocalAttribute('recursion_count', int)
+    deadline = ThreadLocalAttribute('deadline')
+
+    def __init__(self):
+        self.local = threading.local()
+        super(OdnoklassnikiApi, self).__init__()
+
     def get_consistent_token(self):
         return getattr(settings, 'ODNOKLASSNIKI_API_ACCESS_TOKEN', None)
 
     def get_api(self, token):
-        return api.Odnoklassniki(application_key=APPLICATION_PUBLIC, application_secret=APPLICATION_SECRET, token=token)
+        from .transport import Odnoklassniki
+        return Odnoklassniki(application_key=APPLICATION_PUBLIC, application_secret=APPLICATION_SECRET, token=token)
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Call method, argument `deadline` - time, after that call is not repeated after errors any more
+        '''
+        deadline = kwargs.pop('deadline', None)
+        if deadline is None:
+            return super(OdnoklassnikiApi, self).call(method, *args, **kwargs)
+
+        previous = self.deadline
+        self.deadline = deadline
+        try:
+            return super(OdnoklassnikiApi, self).call(method, *args, **kwargs)
+        finally:
+            self.deadline = previous
 
     def get_api_response(self, *args, **kwargs):
-        return self.api._get(self.method, *args, **kwargs)
+        method = self.method
+        breaker = get_circuit_breaker()
+        if not breaker.allow(method):
+            raise OdnoklassnikiCircuitOpenError(self.get_error_data('Circuit is open after errors of server', kwargs))
+
+        priority, budget = get_api_priority(), get_api_budget()
+        self.wait_budget(priority, budget)
+        if self.deadline is not None:
+            from .transport import get_timeout
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise OdnoklassnikiDeadlineError(self.get_error_data('Deadline of call is exceeded', kwargs))
+            kwargs['timeout'] = tuple([min(timeout, remaining) for timeout in get_timeout()])
+
+        api = self.api
+        started = time.time()
+        try:
+            delay = self.get_hedge_delay(method)
+            if delay is None:
+                response = api._get(method, *args, **kwargs)
+            else:
+                def hedge():
+                    # duplicated request is charged in budget of calls as well
+                    self.wait_budget(priority, budget)
+                    return api._get(method, *args, **kwargs)
+                response = hedged_call(lambda: api._get(method, *args, **kwargs), delay, hedge)
+        except OdnoklassnikiError, e:
+            if self.is_server_error(e):
+                breaker.failure(method)
+            raise
+
+        breaker.success(method)
+        latency_tracker.register(method, time.time() - started)
+        return response
+
+    def wait_budget(self, priority, budget=None):
+        get_rate_limiter().wait(priority)
+        if budget is not None:
+            budget.wait()
+
+    def get_error_data(self, text, kwargs):
+        return {'code': None, 'text': text, 'method': self.method, 'params': kwargs}
+
+    def get_hedge_delay(self, method):
+        '''
+        Return latency of read method, after that the same request is sent once more in parallel,
+        from setting ODNOKLASSNIKI_API_HEDGE_PERCENTILE, None - hedging is disabled
+        '''
+        percent = getattr(settings, 'ODNOKLASSNIKI_API_HEDGE_PERCENTILE', None)
+        if percent and is_read_method(method):
+            return latency_tracker.percentile(method, percent)
+        return None
+
+    def is_server_error(self, e):
+        return e.code in (None, 2) or e.message == 'HTTP error'
+
+    def sleep_repeat_call(self, *args, **kwargs):
+        if self.deadline is not None and time.time() + kwargs.get('seconds', 1) >= self.deadline:
+            raise OdnoklassnikiDeadlineError(self.get_error_data('Deadline of call is exceeded', kwargs))
+        return super(OdnoklassnikiApi, self).sleep_repeat_call(*args, **kwargs)
+
+    def repeat_overloaded_call(self, e, *args, **kwargs):
+        if is_failing_on_overload():
+            return self.log_and_raise(e, *args, **kwargs)
+        return self.sleep_repeat_call(*args, **kwargs)
 
     def handle_error_code(self, e, *args, **kwargs):
-        if e.code is None and e.message == 'HTTP error':
-            return self.sleep_repeat_call(*args, **kwargs)
+        if isinstance(e, (OdnoklassnikiDeadlineError, OdnoklassnikiCircuitOpenError)):
+            return self.log_and_raise(e, *args, **kwargs)
+        elif e.code is None and e.message == 'HTTP error':
+            return self.repeat_overloaded_call(e, *args, **kwargs)
         else:
             return super(OdnoklassnikiApi, self).handle_error_code(e, *args, **kwargs)
 
     def handle_error_code_2(self, e, *args, **kwargs):
         # SERVICE : Service is temporary unavailable., logged by ID :
-        return self.sleep_repeat_call(*args, **kwargs)
+        return self.repeat_overloaded_call(e, *args, **kwargs)
 
     def handle_error_code_8(self, e, *args, **kwargs):
         # FLOOD_BLOCKED : Call blocked due to flood protection
@@ -47,6 +194,79 @@ class OdnoklassnikiApi(ApiAbstractBase):
         return self.repeat_call(*args, **kwargs)
 
 
-def api_call(*args, **kwargs):
+_rate_limiter = None
+_circuit_breaker = None
+latency_tracker = LatencyTracker()
+
+
+def get_rate_limiter():
+    '''
+    Return rate limiter of API calls of process. Settings:
+     * ODNOKLASSNIKI_API_CALLS_PER_SECOND - budget of calls, None - unlimited;
+     * ODNOKLASSNIKI_API_RESERVED_SHARE - share of budget, reserved for calls of high and normal priority, 0.2.
+    '''
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = PriorityRateLimiter(getattr(settings, 'ODNOKLASSNIKI_API_CALLS_PER_SECOND', None),
+                                            getattr(settings, 'ODNOKLASSNIKI_API_RESERVED_SHARE', 0.2))
+    return _rate_limiter
+
+
+def get_circuit_breaker():
+    '''
+    Return circuit breaker of API methods of process. Settings:
+     * ODNOKLASSNIKI_API_BREAKER_THRESHOLD - number of server errors in a row, after that calls of method
+       fail fast, None - disabled by default;
+     * ODNOKLASSNIKI_API_BREAKER_RESET - seconds, after that the next call of method is tried, 30.
+    '''
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        _circuit_breaker = CircuitBreaker(getattr(settings, 'ODNOKLASSNIKI_API_BREAKER_THRESHOLD', None),
+                                          getattr(settings, 'ODNOKLASSNIKI_API_BREAKER_RESET', 30))
+    return _circuit_breaker
+
+
+single_flight = SingleFlight()
+cache_single_flight = CacheSingleFlight()
+
+
+def is_read_method(method):
+    return method.split('.')[-1].startswith('get')
+
+
+def get_call_key(method, kwargs, deadline=None):
+    context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', {}).get(OdnoklassnikiApi.provider, {})
+    # calls of higher priority don't wait for calls of lower one in budget of calls,
+    # calls with deadline or failing on overload don't wait for repeats of call without them
+    return repr((method, sorted(kwargs.items()), context.get('token'), get_api_priority(), deadline,
+                 is_failing_on_overload()))
+
+
+def api_call(method, *args, **kwargs):
+    '''
+    Call API method. Concurrent identical calls of read methods (get*) share one request, argument `coalesce`
+    forces or disables it. Argument `priority` sets priority of call in budget of calls,
+    argument `deadline` - seconds for call with all it's repeats after errors. Settings:
+     * ODNOKLASSNIKI_API_COALESCE - coalesce calls by default, True;
+     * ODNOKLASSNIKI_API_COALESCE_CACHE - coalesce calls of different processes through Django cache, False;
+     * ODNOKLASSNIKI_API_CALL_DEADLINE - default deadline of call, None - without deadline.
+    '''
+    priority = kwargs.pop('priority', None)
+    if priority is not None:
+        with api_priority(priority):
+            return api_call(method, *args, **kwargs)
+
+    deadline = kwargs.pop('deadline', getattr(settings, 'ODNOKLASSNIKI_API_CALL_DEADLINE', None))
+    coalesce = kwargs.pop('coalesce', None)
+    if coalesce is None:
+        coalesce = getattr(settings, 'ODNOKLASSNIKI_API_COALESCE', True) and is_read_method(method)
+    key = get_call_key(method, kwargs, deadline) if coalesce else None
+
+    if deadline is not None:
+        kwargs['deadline'] = time.time() + deadline
+
     api = OdnoklassnikiApi()
-    return api.call(*args, **kwargs)
+    if coalesce:
+        flight = cache_single_flight if getattr(settings, 'ODNOKLASSNIKI_API_COALESCE_CACHE', False) else single_flight
+        return flight.do_until(key, kwargs.get('deadline'), api.call, method, *args, **kwargs)
+    return api.call(method, *args, **kwargs)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import gzip
+import os
+import threading
+from datetime import datetime
+from StringIO import StringIO
+
+import simplejson as json
+from django.conf import settings
+from django.db.models import Model, get_model
+from django.utils import timezone
+
+__all__ = ['ResponseArchive', 'get_archive']
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_archive():
+    '''
+    Return archive from setting ODNOKLASSNIKI_API_ARCHIVE_PATH or None if archiving is disabled
+    '''
+    path = getattr(settings, 'ODNOKLASSNIKI_API_ARCHIVE_PATH', None)
+    if not path:
+        return None
+    with _archives_lock:
+        if path not in _archives:
+            _archives[path] = ResponseArchive(path)
+        return _archives[path]
+
+
+class ResponseArchive(object):
+
+    '''
+    Appendable archive of raw API responses. Each response is written to `responses.jsonl.gz`
+    as separate gzip member with JSON line, and it's offset is written to `responses.idx`
+    with model, method, extra fields and time of fetching, so responses could be read and replayed one by one.
+    Files are locked while appending, so archive could be shared by several processes
+    '''
+    data_filename = 'responses.jsonl.gz'
+    index_filename = 'responses.idx'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def data_path(self):
+        return os.path.join(self.path, self.data_filename)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, self.index_filename)
+
+    def get_model_label(self, model):
+        return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+    def dump_extra_fields(self, extra_fields):
+        '''
+        Return JSON-compatible dict of extra fields, related instances are replaced with model and pk
+        '''
+        values = {}
+        for key, value in (extra_fields or {}).items():
+            if key == 'fetched':
+                continue
+            if isinstance(value, Model):
+                value = {'__model__': self.get_model_label(value.__class__), 'pk': value.pk}
+            values[key] = value
+        return values
+
+    def load_extra_fields(self, values):
+        extra_fields = {}
+        for key, value in (values or {}).items():
+            if isinstance(value, dict) and '__model__' in value:
+                model = get_model(*value['__model__'].split('.'))
+                try:
+                    value = model.objects.get(pk=value['pk'])
+                except model.DoesNotExist:
+                    value = model(pk=value['pk'])
+            extra_fields[key] = value
+        return extra_fields
+
+    def append(self, model, method, kwargs, response, fetched=None, extra_fields=None):
+        buffer = StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+            f.write(json.dumps(response) + '\n')
+        data = buffer.getvalue()
+
+        with self.lock:
+            with open(self.data_path, 'ab') as f:
+                # offset is taken and index is written under lock shared with other processes
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                    f.write(data)
+                    f.flush()
+                    with open(self.index_path, 'a') as index:
+                        index.write(json.dumps({
+                            'offset': offset,
+                            'length': len(data),
+                            'model': self.get_model_label(model),
+                            'method': method,
+                            'kwargs': kwargs,
+                            'extra_fields': self.dump_extra_fields(extra_fields),
+                            'fetched': (fetched or timezone.now()).strftime('%Y-%m-%dT%H:%M:%S'),
+                        }, default=unicode) + '\n')
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self, offset, length):
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return json.loads(gzip.GzipFile(fileobj=StringIO(data)).read())
+
+    def __iter__(self):
+        '''
+        Iterate over index entries
+        '''
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                entry['fetched'] = datetime.strptime(entry['fetched'], '%Y-%m-%dT%H:%M:%S').replace(
+                    tzinfo=timezone.utc)
+                yield entry
+
+    def replay(self, models=None, since=None):
+        '''
+        Parse archived responses again and save objects to DB without calls of API.
+        Responses could be filtered by list of `models` and by time of fetching `since`.
+        Return number of replayed responses
+        '''
+        labels = [self.get_model_label(model) for model in models] if models else None
+        count = 0
+        for entry in self:
+            if labels and entry['model'] not in labels or since and entry['fetched'] < since:
+                continue
+            model = get_model(*entry['model'].split('.'))
+            response = self.read(entry['offset'], entry['length'])
+            extra_fields = self.load_extra_fields(entry.get('extra_fields'))
+            extra_fields['fetched'] = entry['fetched']
+            model.remote.save_response(response, extra_fields)
+            count += 1
+        return count
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime, timedelta
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import islice
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Model
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from django.utils.functional import wraps
 
 try:
@@ -11,13 +18,17 @@ except ImportError:
     from django.db.transaction import commit_on_success as atomic
 
 from .exceptions import OdnoklassnikiContentError
+from .expiry import ExpirationPlanner
+from .resilience import fail_on_overload
+from .scheduler import PRIORITY_LOW, api_priority
+from .signals import chunk_fetched
+from .singleflight import Flight
+from .utils import is_lazy_iterable, iter_values, list_chunks_iterator
 
+log = logging.getLogger('odnoklassniki_api')
 
-def list_chunks_iterator(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in xrange(0, len(l), n):
-        yield l[i:i+n]
+# max number of pks in condition IN of result of fetch_by_chunks_of, SQLite allows 999 variables in query
+FETCHED_PKS_LIMIT = 900
 
 
 def opt_arguments(func):
@@ -90,7 +101,9 @@ def fetch_all(func, return_all=None, always_all=False, pagination='anchor', has_
             if instances_count and (has_more in response and response[has_more]
                                     or has_more not in response and pagination in response):
                 kwargs[pagination] = response.get(pagination)
-                return wrapper(self, all=all, instances_all=instances_all, **kwargs)
+                # the next pages are fetched as background calls
+                with api_priority(PRIORITY_LOW, force=False):
+                    return wrapper(self, all=all, instances_all=instances_all, **kwargs)
 
             if return_all:
                 kwargs['instances'] = instances_all
@@ -104,78 +117,299 @@ def fetch_all(func, return_all=None, always_all=False, pagination='anchor', has_
 
 
 @opt_arguments
-def fetch_only_expired(func, timeout_days, expiration_fieldname='fetched', ids_argument='ids'):
+def fetch_only_expired(func, timeout_days, expiration_fieldname='fetched', ids_argument='ids', **planner_kwargs):
     """
     Class method decorator for fetching only expired items. Add parameter `only_expired=False` for decored method.
     If `only_expired` is True, method substitute argument `ids_argument` with new value, that consist only expired ids.
+    Expired ids are passed sorted and without duplicates. If ids are passed as generator or queryset,
+    expired ids are passed as generator too.
     Decorator receive parameters:
       * `timeout_days` int, number of day, after that instance is suppose to be expired.
       * `expiration_fieldname` string, name of datetime field, that indicate time of instance last fetching
       * `ids_argument` string, name of argument, that store list of ids.
+      * `batch_size` and `cache_size` of ExpirationPlanner: number of ids checked in DB by one query
+        and number of recently fetched ids, that are not checked in DB at all.
     Usage:
 
         @fetch_only_expired(timeout_days=3)
         def fetch_something(self, ..., *kwargs):
         ....
     """
+    planner = ExpirationPlanner(timeout_days, expiration_fieldname, **planner_kwargs)
+
     def wrapper(self, only_expired=False, *args, **kwargs):
 
         if len(args) > 0:
             raise ValueError("It's prohibited to use non-key arguments for method decorated with @fetch_all, "
                              "method is %s.%s(), args=%s" % (self.__class__.__name__, func.__name__, args))
 
-        if only_expired:
-            ids = kwargs[ids_argument]
-            expired_at = datetime.now() - timedelta(timeout_days)
-            ids_non_expired = self.model.objects.filter(**{'%s__gte' % expiration_fieldname: expired_at,
-                                                           'pk__in': ids}).values_list('pk', flat=True)
-            kwargs[ids_argument] = list(set(ids).difference(set(ids_non_expired)))
+        if only_expired and is_lazy_iterable(kwargs[ids_argument]):
+            # expired ids are checked by batches while they are consumed by decorated method
+            kwargs[ids_argument] = planner.iter_expired(self.model, kwargs[ids_argument])
+            return func(self, **kwargs)
+        elif only_expired:
+            ids_expired, ids_non_expired = planner.split(self.model, kwargs[ids_argument])
+            kwargs[ids_argument] = normalize_ids(ids_expired)
 
-            instances = None
+            if kwargs.get('queue'):
+                # expired ids are fetched by workers of queue later
+                return func(self, **kwargs)
             if len(kwargs[ids_argument]):
-                instances = func(self, **kwargs)
-            return renew_if_not_equal(self.model, instances, ids)
+                pks = list(get_instances_pks(func(self, **kwargs)))
+                planner.register_fetched(self.model, pks)
+                ids_non_expired.update(pks)
+            return self.model.objects.filter(pk__in=ids_non_expired)
 
         return func(self, **kwargs)
 
     return wraps(func)(wrapper)
 
 
+class AdaptiveChunkSize(object):
+
+    '''
+    Size of chunk for decorator `fetch_by_chunks_of` in adaptive mode.
+    Starts from `items_limit`, halves after slow or failed call and doubles back up to `items_limit` after fast one
+    '''
+    # error codes, that mean server is overloaded: None - HTTP error or timeout, 2 - service is temporary unavailable
+    shrink_error_codes = (None, 2)
+
+    def __init__(self, items_limit, min_items_limit=1, slow_seconds=10, fast_seconds=2):
+        self.items_limit = items_limit
+        self.min_items_limit = min(min_items_limit, items_limit)
+        self.slow_seconds = slow_seconds
+        self.fast_seconds = fast_seconds
+        self.size = items_limit
+
+    def shrink(self):
+        self.size = max(self.min_items_limit, self.size // 2)
+
+    def grow(self):
+        self.size = min(self.items_limit, self.size * 2)
+
+    def can_shrink(self, e=None):
+        '''
+        Return True if chunk could be smaller and error `e` means overloaded server.
+        Errors of exceeded deadline and open circuit are not caused by size of chunk
+        '''
+        from .api import OdnoklassnikiCircuitOpenError, OdnoklassnikiDeadlineError
+
+        if self.size <= self.min_items_limit:
+            return False
+        if e is None:
+            return True
+        return getattr(e, 'code', None) in self.shrink_error_codes \
+            and not isinstance(e, (OdnoklassnikiCircuitOpenError, OdnoklassnikiDeadlineError))
+
+    def register(self, duration):
+        if duration >= self.slow_seconds:
+            self.shrink()
+        elif duration <= self.fast_seconds:
+            self.grow()
+
+
+class IdsBatch(Flight):
+
+    def __init__(self):
+        super(IdsBatch, self).__init__()
+        self.ids = set()
+
+
+class IdsMicroBatcher(object):
+
+    '''
+    Merge ids of concurrent calls with the same key into one batch. The first call waits `window` seconds,
+    collecting ids of other calls, fetches all of them and shares set of fetched pks with other calls
+    '''
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.batches = {}
+
+    def fetch(self, key, ids, fetch):
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.batches[key] = IdsBatch()
+            batch.ids.update(ids)
+
+        if not leader:
+            batch.event.wait()
+            if batch.exc_info:
+                raise batch.exc_info[0], batch.exc_info[1], batch.exc_info[2]
+            return batch.result
+
+        time.sleep(self.window)
+        with self.lock:
+            del self.batches[key]
+
+        try:
+            batch.result = fetch(normalize_ids(batch.ids))
+            return batch.result
+        except Exception:
+            batch.exc_info = sys.exc_info()
+            raise
+        finally:
+            batch.event.set()
+
+
+def normalize_ids(ids):
+    '''
+    Return sorted list of unique ids
+    '''
+    return sorted(set(ids))
+
+
 @opt_arguments
-def fetch_by_chunks_of(func, items_limit, ids_argument='ids'):
+def fetch_by_chunks_of(func, items_limit, ids_argument='ids', adaptive=False, batch_window=0, **adaptive_kwargs):
     """
     Class method decorator for fetching ammount of items bigger than allowed at once.
+    Duplicated ids are fetched only once.
     Decorator receive parameters:
       * `items_limit`. Max limit of allowned items to fetch at once
       * `ids_argument` string, name of argument, that store list of ids.
+      * `adaptive` bool, change size of chunks depending on response time and errors of server,
+        `min_items_limit`, `slow_seconds` and `fast_seconds` of AdaptiveChunkSize could be specified as well.
+        Calls with errors of overloaded server are not repeated by API, chunk is repeated with smaller size instead.
+      * `batch_window` float, seconds for merging ids of concurrent calls with the same other arguments
+        into shared chunks, 0 - disabled.
+    After each chunk signal `chunk_fetched` is sent.
+    If decorated method is called with argument `queue`, chunks are put as jobs into WorkQueue with this name
+    for fetching by workers, and number of jobs is returned.
+    Ids could be passed as generator, iterator or queryset: they are consumed chunk by chunk without loading
+    all of them into memory (queryset is read by server-side cursor on PostgreSQL), duplicates are removed
+    only inside chunk, and number of saved objects is returned instead of queryset.
     Usage:
 
         @fetch_by_chunks_of(1000)
         def fetch_something(self, ..., *kwargs):
         ....
+
+        @fetch_by_chunks_of(1000, adaptive=True, slow_seconds=5)
+        def fetch_something(self, ..., *kwargs):
+        ....
     """
+    if adaptive_kwargs and not adaptive:
+        raise TypeError("Arguments %s of decorator fetch_by_chunks_of are allowed only with adaptive=True"
+                        % ', '.join(sorted(adaptive_kwargs)))
+    batcher = IdsMicroBatcher(batch_window) if batch_window else None
+
+    def fetch_chunks(self, ids, kwargs, pks=None):
+        '''
+        Fetch ids by chunks, add pks of saved objects to set `pks`, return number of saved objects.
+        Ids are consumed from iterable chunk by chunk, duplicates are removed inside chunk
+        '''
+        from .api import OdnoklassnikiError
+
+        kwargs_sliced = dict(kwargs)
+        count = 0
+        chunk_size = AdaptiveChunkSize(items_limit, **adaptive_kwargs) if adaptive else None
+        ids = iter_values(ids, items_limit)
+        chunk = []
+        while True:
+            size = chunk_size.size if adaptive else items_limit
+            # ids of failed chunk are fetched again by smaller chunks
+            chunk = normalize_ids(chunk + list(islice(ids, size - len(chunk)))) if len(chunk) < size else chunk
+            if not chunk:
+                break
+            kwargs_sliced[ids_argument], rest = chunk[:size], chunk[size:]
+            chunk = kwargs_sliced[ids_argument]
+            started = time.time()
+            try:
+                # errors of overloaded server are raised instead of repeating call, while chunk could be smaller
+                with fail_on_overload(adaptive and chunk_size.can_shrink()):
+                    instances = func(self, **kwargs_sliced)
+            except OdnoklassnikiError, e:
+                if not adaptive or not chunk_size.can_shrink(e):
+                    raise
+                chunk_size.shrink()
+                log.warning("Chunk of %d ids of method %s failed with error '%s', shrink chunk size to %d" %
+                            (len(chunk), func.__name__, e, chunk_size.size))
+                # ids of failed chunk are fetched before the rest of buffer
+                chunk = chunk + rest
+                continue
+            duration = time.time() - started
+            instances_pks = get_instances_pks(instances)
+            count += len(instances_pks)
+            if pks is not None:
+                pks.update(instances_pks)
+
+            chunk_fetched.send(sender=self.model, items_limit=items_limit, chunk_size=len(chunk),
+                               duration=duration)
+            if adaptive:
+                chunk_size.register(duration)
+                log.debug("Chunk of %d ids of method %s fetched in %.2f sec, next chunk size is %d" %
+                          (len(chunk), func.__name__, duration, chunk_size.size))
+            chunk = rest
+        return count
+
+    def get_fetched_pks(self, ids, kwargs):
+        pks = set()
+        fetch_chunks(self, ids, kwargs, pks)
+        return pks
+
     def wrapper(self, *args, **kwargs):
 
         if len(args) > 0:
             raise ValueError("It's prohibited to use non-key arguments for method decorated with @fetch_all, "
                              "method is %s.%s(), args=%s" % (self.__class__.__name__, func.__name__, args))
 
+        queue = kwargs.pop('queue', None)
         ids = kwargs[ids_argument]
-        if ids:
-            kwargs_sliced = dict(kwargs)
-            for chunk in list_chunks_iterator(ids, items_limit):
-                kwargs_sliced[ids_argument] = chunk
-                instances = func(self, **kwargs_sliced)
+        if is_lazy_iterable(ids):
+            # ids are not kept in memory, so number of saved objects is returned instead of queryset
+            if queue:
+                from .workqueue import WorkQueue
+                kwargs.pop(ids_argument)
+                return WorkQueue(queue).enqueue(self, func.__name__, ids, items_limit, ids_argument, kwargs)
+            return fetch_chunks(self, ids, kwargs)
+        elif ids:
+            ids = normalize_ids(ids)
+            # without microseconds, that are truncated by some databases
+            started = datetime.utcnow().replace(tzinfo=timezone.utc, microsecond=0)
+            if queue:
+                from .workqueue import WorkQueue
+                kwargs.pop(ids_argument)
+                return WorkQueue(queue).enqueue(self, func.__name__, ids, items_limit, ids_argument, kwargs)
+            elif batcher:
+                key = repr((self.model, sorted([(k, v) for k, v in kwargs.items() if k != ids_argument])))
+                pks = batcher.fetch(key, ids, lambda ids: get_fetched_pks(self, ids, kwargs))
+                # objects of other calls are excluded, if it's possible to match them with ids
+                if self.model._meta.pk.name == self.model.remote_pk_local_field:
+                    pks = pks.intersection(ids)
+            else:
+                pks = get_fetched_pks(self, ids, kwargs)
 
-            return renew_if_not_equal(self.model, instances, ids)
+            return get_fetched_queryset(self.model, pks, started)
         else:
             return func(self, **kwargs)
 
     return wraps(func)(wrapper)
 
 
-def renew_if_not_equal(model, instances, ids):
-    return instances if instances is not None and len(ids) == instances.count() else model.objects.filter(pk__in=ids)
+def get_fetched_queryset(model, pks, started):
+    '''
+    Return lazy queryset of objects saved from all chunks. If there are too many pks for one condition IN,
+    objects are selected by time of fetching `fetched` since `started` in range of pks
+    '''
+    if len(pks) <= FETCHED_PKS_LIMIT:
+        return model.objects.filter(pk__in=pks)
+    return model.objects.filter(fetched__gte=started, pk__gte=min(pks), pk__lte=max(pks))
+
+
+def get_instances_pks(instances):
+    '''
+    Return primary keys of instances returned by decorated method: queryset, list of instances or single instance
+    '''
+    if instances is None:
+        return []
+    elif isinstance(instances, QuerySet):
+        return instances.values_list('pk', flat=True)
+    elif isinstance(instances, Model):
+        return [instances.pk]
+    else:
+        return [instance.pk for instance in instances]
 
 
 def opt_generator(func):
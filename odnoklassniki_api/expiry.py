@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import connections, router
+from django.utils import timezone
+
+from .utils import list_chunks_iterator
+
+
+class FetchedIdsCache(object):
+
+    '''
+    In-memory LRU cache of recently fetched ids with time of fetching
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, id):
+        with self.lock:
+            fetched = self.items.pop(id, None)
+            if fetched is not None:
+                self.items[id] = fetched
+            return fetched
+
+    def set(self, id, fetched):
+        with self.lock:
+            self.items.pop(id, None)
+            self.items[id] = fetched
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class ExpirationPlanner(object):
+
+    '''
+    Split list of ids on expired and non expired ones for decorator `fetch_only_expired`.
+    Ids are checked by batches of `batch_size`. Ids, fetched recently by the same planner, are kept
+    in the LRU cache of `cache_size` items and are not checked in DB.
+    '''
+    def __init__(self, timeout_days, expiration_fieldname='fetched', batch_size=1000, cache_size=0):
+        self.timeout_days = timeout_days
+        self.expiration_fieldname = expiration_fieldname
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.caches = {}
+
+    def get_cache(self, model):
+        if not self.cache_size:
+            return None
+        if model not in self.caches:
+            self.caches[model] = FetchedIdsCache(self.cache_size)
+        return self.caches[model]
+
+    def get_expired_at(self):
+        return timezone.now() - timedelta(self.timeout_days)
+
+    def split(self, model, ids):
+        '''
+        Return list of expired ids and set of non expired ids
+        '''
+        expired_at = self.get_expired_at()
+        ids_non_expired = set()
+        ids_unknown = []
+        ids_seen = set()
+
+        cache = self.get_cache(model)
+        for id in ids:
+            if id in ids_seen:
+                continue
+            ids_seen.add(id)
+            fetched = cache.get(id) if cache else None
+            if fetched is not None and fetched >= expired_at:
+                ids_non_expired.add(id)
+            else:
+                ids_unknown += [id]
+
+        for chunk in list_chunks_iterator(ids_unknown, self.batch_size):
+            ids_non_expired.update(self.get_non_expired_ids(model, chunk, expired_at))
+
+        return [id for id in ids_unknown if id not in ids_non_expired], ids_non_expired
+
+    def iter_expired(self, model, ids):
+        '''
+        Yield expired ids of iterable, checking them by batches
+        '''
+        for chunk in list_chunks_iterator(ids, self.batch_size):
+            for id in self.split(model, chunk)[0]:
+                yield id
+
+    def get_non_expired_ids(self, model, ids, expired_at):
+        using = router.db_for_read(model)
+        if connections[using].vendor == 'postgresql':
+            return self.get_non_expired_ids_postgresql(model, ids, expired_at, using)
+
+        return model.objects.using(using).filter(**{'%s__gte' % self.expiration_fieldname: expired_at,
+                                                    'pk__in': ids}).values_list('pk', flat=True)
+
+    def get_non_expired_ids_postgresql(self, model, ids, expired_at, using):
+        # join with array of ids passed as a single parameter instead of building huge IN clause
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        pk_column = model._meta.pk.column
+        sql = 'SELECT t.%s FROM %s t JOIN unnest(%%s) AS ids(id) ON t.%s = ids.id WHERE t.%s >= %%s' % (
+            qn(pk_column), qn(model._meta.db_table), qn(pk_column),
+            qn(model._meta.get_field(self.expiration_fieldname).column))
+        cursor = connection.cursor()
+        cursor.execute(sql, [list(ids), expired_at])
+        return [row[0] for row in cursor.fetchall()]
+
+    def register_fetched(self, model, ids):
+        cache = self.get_cache(model)
+        if cache:
+            fetched = timezone.now()
+            for id in ids:
+                cache.set(id, fetched)
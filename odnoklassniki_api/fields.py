@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import connections, models, router
+from django.db.models import signals
 from django.core import validators
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 from annoying.fields import JSONField
 from picklefield.fields import PickledObjectField
@@ -52,6 +55,205 @@ class IntegerRangeField(models.IntegerField):
         defaults.update(kwargs)
         return super(IntegerRangeField, self).formfield(**defaults)
 
+class MultiValueField(six.with_metaclass(models.SubfieldBase, models.Field)):
+    '''
+    Field for list of values of `base_field`, indexed for containment lookups `has`, `has_any` and `has_all`:
+     * on PostgreSQL values are stored in array with GIN index, created after migration;
+     * on other databases values are stored as JSON list and duplicated in side table `<table>_<field>`
+       with index on value, that is updated after saving of instance.
+    Custom lookups are supported since Django 1.7, field can't be used with earlier versions.
+    '''
+    description = _("List of values")
+
+    def __init__(self, verbose_name=None, name=None, base_field=None, **kwargs):
+        if not hasattr(models, 'Lookup'):
+            raise ImproperlyConfigured("MultiValueField requires Django 1.7 or later for lookups of values")
+        self.base_field = base_field or models.CharField(max_length=255)
+        kwargs.setdefault('default', list)
+        kwargs.setdefault('blank', True)
+        super(MultiValueField, self).__init__(verbose_name, name, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(MultiValueField, self).deconstruct()
+        kwargs['base_field'] = self.base_field
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return '%s[]' % self.base_field.db_type(connection)
+        return models.TextField().db_type(connection)
+
+    def contribute_to_class(self, cls, name):
+        super(MultiValueField, self).contribute_to_class(cls, name)
+        self.values_model = None
+        if not cls._meta.abstract:
+            # side table is not needed, if model is stored in PostgreSQL
+            if connections[router.db_for_write(cls)].vendor != 'postgresql':
+                self.values_model = create_values_model(self, cls)
+                # one receiver for all multi-value fields of model
+                signals.post_save.connect(update_values_table, sender=cls, weak=False,
+                                          dispatch_uid='%s.%s.multi_values' % (cls._meta.app_label, cls.__name__))
+            multi_value_fields.append(self)
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return []
+        if isinstance(value, six.string_types):
+            import simplejson as json
+            value = json.loads(value)
+        return [self.base_field.to_python(item) for item in value]
+
+    def get_prep_value(self, value):
+        return [self.base_field.get_prep_value(item) for item in self.to_python(value)]
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if connection.vendor == 'postgresql':
+            return value
+        import simplejson as json
+        return json.dumps(value)
+
+    def value_to_string(self, obj):
+        import simplejson as json
+        return json.dumps(self.get_prep_value(self._get_val_from_obj(obj)))
+
+
+multi_value_fields = []
+
+
+def create_values_model(field, cls):
+    '''
+    Create model of side table with values of field for indexing on databases without arrays
+    '''
+    name = '%s_%s' % (cls._meta.object_name, field.name)
+    base_field = field.base_field.clone()
+    base_field.db_index = True
+    meta = {
+        'db_table': '%s_%s' % (cls._meta.db_table, field.column),
+        'app_label': cls._meta.app_label,
+        'unique_together': ('owner', 'value'),
+    }
+    if hasattr(cls._meta, 'apps'):
+        meta['apps'] = cls._meta.apps
+    return type(str(name), (models.Model,), {
+        'Meta': type(str('Meta'), (object,), meta),
+        '__module__': cls.__module__,
+        'owner': models.ForeignKey(cls, related_name='%s+' % name),
+        'value': base_field,
+    })
+
+
+def update_values_table(sender, instance, using, created=False, **kwargs):
+    update_multi_value_tables(sender, [instance], using, created)
+
+
+def update_field_values(field, instances, using, created=False):
+    '''
+    Bring values of instances in side table of field in line with current ones:
+    delete removed values and insert added ones
+    '''
+    values_model = field.values_model
+    manager = values_model.objects.using(using)
+    values = dict((instance.pk, set(field.get_prep_value(getattr(instance, field.attname)))) for instance in instances)
+
+    stored = dict((pk, set()) for pk in values)
+    if not created:
+        for pk, value in manager.filter(owner__in=values.keys()).values_list('owner', 'value'):
+            stored[pk].add(value)
+
+    for pk, removed in stored.items():
+        removed = removed - values[pk]
+        if removed:
+            manager.filter(owner=pk, value__in=removed).delete()
+    manager.bulk_create([values_model(owner_id=pk, value=value)
+                         for pk in values for value in values[pk] - stored[pk]])
+
+
+def update_multi_value_tables(model, instances, using, created=False):
+    '''
+    Update side tables of multi-value fields for instances, saved without post_save signal, e.g. by bulk_create()
+    '''
+    if connections[using].vendor != 'postgresql':
+        for field in model._meta.fields:
+            if isinstance(field, MultiValueField) and field.values_model:
+                update_field_values(field, instances, using, created)
+
+
+def create_gin_indexes(sender=None, **kwargs):
+    connection = connections[kwargs.get('using') or kwargs.get('db') or 'default']
+    if connection.vendor != 'postgresql':
+        return
+    tables = connection.introspection.table_names()
+    cursor = connection.cursor()
+    for field in multi_value_fields:
+        table = field.model._meta.db_table
+        index = '%s_%s_gin' % (table, field.column)
+        if table not in tables:
+            continue
+        # instead of CREATE INDEX IF NOT EXISTS, that is available since PostgreSQL 9.5
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s', [table, index])
+        if cursor.fetchone() is None:
+            cursor.execute('CREATE INDEX %s ON %s USING gin (%s)' % (
+                connection.ops.quote_name(index),
+                connection.ops.quote_name(table), connection.ops.quote_name(field.column)))
+
+if hasattr(signals, 'post_migrate'):
+    signals.post_migrate.connect(create_gin_indexes)
+else:
+    signals.post_syncdb.connect(create_gin_indexes)
+
+
+class MultiValueLookup(models.Lookup if hasattr(models, 'Lookup') else object):
+    '''
+    Containment lookup for MultiValueField: `@>` and `&&` operators of arrays on PostgreSQL,
+    subquery to side table with values on other databases
+    '''
+    def get_prep_lookup(self):
+        values = [self.rhs] if self.lookup_name == 'has' else self.rhs
+        return list(set(self.lhs.output_field.base_field.get_prep_value(value) for value in values))
+
+    def as_sql(self, qn, connection):
+        lhs, params = self.process_lhs(qn, connection)
+        field = self.lhs.output_field
+        if not self.rhs:
+            return ('1 = 1', []) if self.lookup_name == 'has_all' else ('1 = 0', [])
+
+        if connection.vendor == 'postgresql':
+            operator = '&&' if self.lookup_name == 'has_any' else '@>'
+            return '%s %s %%s::%s' % (lhs, operator, field.db_type(connection)), params + [self.rhs]
+
+        values_model = field.values_model
+        if values_model is None:
+            raise ImproperlyConfigured("Side table of values of %s.%s is not created for %s database" % (
+                field.model.__name__, field.name, connection.vendor))
+        sql = '%s.%s IN (SELECT %s FROM %s WHERE %s IN (%s)' % (
+            qn(self.lhs.alias), qn(field.model._meta.pk.column),
+            qn(values_model._meta.get_field('owner').column), qn(values_model._meta.db_table),
+            qn(values_model._meta.get_field('value').column), ', '.join(['%s'] * len(self.rhs)))
+        if self.lookup_name == 'has_all':
+            sql += ' GROUP BY %s HAVING COUNT(*) = %d' % (qn(values_model._meta.get_field('owner').column),
+                                                         len(self.rhs))
+        return sql + ')', params + self.rhs
+
+
+class HasLookup(MultiValueLookup):
+    lookup_name = 'has'
+
+
+class HasAnyLookup(MultiValueLookup):
+    lookup_name = 'has_any'
+
+
+class HasAllLookup(MultiValueLookup):
+    lookup_name = 'has_all'
+
+# custom lookups are supported since Django 1.7
+if hasattr(models, 'Lookup'):
+    MultiValueField.register_lookup(HasLookup)
+    MultiValueField.register_lookup(HasAnyLookup)
+    MultiValueField.register_lookup(HasAllLookup)
+
 try:
     from south.modelsinspector import add_introspection_rules
     add_introspection_rules([], ["^vkontakte_api\.fields"])
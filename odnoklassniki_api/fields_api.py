@@ -47,7 +47,6 @@ API_REQUEST_FIELDS = {
         'media_app_act_link',
         'media_app_title',
         'media_app_text',
-        'delete_id',
     ],
     'feed': [
         'type',
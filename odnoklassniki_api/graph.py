@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import OrderedDict
+
+from django.db import models
+from django.utils import timezone
+
+from .fields import update_multi_value_tables
+from .instance_cache import invalidate_instances
+from .utils import list_chunks_iterator
+
+__all__ = ['EmbeddedObjectsGraph']
+
+log = logging.getLogger('odnoklassniki_api')
+
+
+class EmbeddedObjectsGraph(object):
+
+    '''
+    Unit of work for related objects, embedded into resources of API response as dicts.
+    Embedded objects of all parsed instances are collected, deduplicated by pk and saved
+    before instances, level by level of dependencies:
+     * new objects are created by bulk_create();
+     * stored objects with the same hash of resource get only new time of fetching by one update;
+     * changed stored objects and objects without pk are saved one by one.
+    '''
+    def __init__(self, using='default', batch_size=1000):
+        self.using = using
+        self.batch_size = batch_size
+        # {model: {pk: [level, instance]}}
+        self.nodes = {}
+        # list of (instance, field name, embedded instance)
+        self.links = []
+
+    def add(self, instance):
+        '''
+        Collect embedded objects of instance recursively, return level of instance in graph
+        '''
+        level = 0
+        for field in instance._meta.fields:
+            if not isinstance(field, (models.ForeignKey, models.OneToOneField)):
+                continue
+            related = getattr(instance, field.get_cache_name(), None)
+            if related is None or not getattr(related, '_embedded', False):
+                continue
+            related_level = self.add(related) + 1
+            related = self.register(related_level, related)
+            self.links += [(instance, field.name, related)]
+            level = max(level, related_level)
+        return level
+
+    def add_many(self, instances):
+        for instance in instances:
+            self.add(instance)
+        return self
+
+    def register(self, level, instance):
+        '''
+        Return the first collected instance with the same pk, it's saved on the deepest level of all duplicates
+        '''
+        nodes = self.nodes.setdefault(instance.__class__, OrderedDict())
+        node = nodes.setdefault(instance.pk if instance.pk is not None else id(instance), [level, instance])
+        node[0] = max(node[0], level)
+        return node[1]
+
+    def save(self):
+        levels = {}
+        for model, nodes in self.nodes.items():
+            for level, instance in nodes.values():
+                levels.setdefault((level, model), []).append(instance)
+
+        for level, model in sorted(levels, key=lambda key: key[0]):
+            self.save_instances(model, levels[(level, model)])
+            # pks of embedded objects are known only after saving, so they are set before saving of next level
+            saved = set([id(instance) for instance in levels[(level, model)]])
+            for instance, field_name, related in self.links:
+                if id(related) in saved:
+                    setattr(instance, field_name, related)
+
+        self.nodes = {}
+        self.links = []
+
+    def save_instances(self, model, instances):
+        now = timezone.now()
+        with_pk = []
+        for instance in instances:
+            instance._embedded = False
+            if hasattr(instance, 'fetched') and instance.fetched is None:
+                instance.fetched = now
+            if instance.pk is None:
+                # remote pk differs from local pk, so object could be resolved by manager only
+                model.remote.get_or_create_from_instance(instance)
+            else:
+                with_pk += [instance]
+
+        for chunk in list_chunks_iterator(with_pk, self.batch_size):
+            stored = model.objects.using(self.using).in_bulk([instance.pk for instance in chunk])
+            created, unchanged = [], []
+            for instance in chunk:
+                old_instance = stored.get(instance.pk)
+                if old_instance is None:
+                    created += [instance]
+                elif instance.resource_hash and instance.resource_hash == old_instance.resource_hash:
+                    unchanged += [instance.pk]
+                else:
+                    # embedded resource contains only part of fields, others are kept from stored object
+                    instance._substitute(old_instance)
+                    instance.save(using=self.using, force_update=True)
+
+            if created:
+                model.objects.using(self.using).bulk_create(created)
+                update_multi_value_tables(model, created, self.using)
+                for instance in created:
+                    instance._state.adding = False
+                    instance._state.db = self.using
+            if unchanged:
+                model.objects.using(self.using).filter(pk__in=unchanged).update(fetched=now)
+                invalidate_instances(model, unchanged)
+
+            log.debug('Saved embedded objects of %s: %d created, %d unchanged, %d updated' %
+                      (model.__name__, len(created), len(unchanged), len(chunk) - len(created) - len(unchanged)))
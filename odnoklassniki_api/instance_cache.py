@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import copy
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import signals
+from django.utils.functional import wraps
+
+__all__ = ['LocMemInstanceCache', 'DjangoInstanceCache', 'commit_cached']
+
+_deferred = threading.local()
+
+
+def in_transaction(using):
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block
+    # Django < 1.6
+    return connection.is_managed()
+
+
+def on_commit(using, func):
+    '''
+    Call `func` after commit of transaction of `using` database: at once outside of transaction,
+    by on_commit() hook since Django 1.9 or on exit of outermost `commit_cached` function.
+    Otherwise call is dropped
+    '''
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if not in_transaction(using):
+        func()
+    elif hasattr(connection, 'on_commit'):
+        connection.on_commit(func)
+    elif getattr(_deferred, 'funcs', None) is not None:
+        _deferred.funcs.append((connection.alias, func))
+
+
+def commit_cached(func):
+    '''
+    Decorator of function with atomic block: changes of instance cache inside it are applied
+    after exit of outermost decorated function, if transaction is committed by that time
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_deferred, 'funcs', None) is not None:
+            return func(*args, **kwargs)
+
+        _deferred.funcs = []
+        try:
+            result = func(*args, **kwargs)
+            funcs = _deferred.funcs
+        finally:
+            _deferred.funcs = None
+
+        for using, deferred in funcs:
+            # otherwise function is called inside transaction of caller, that could be rolled back
+            if not in_transaction(using):
+                deferred()
+        return result
+    return wrapper
+
+
+class InstanceCache(object):
+
+    '''
+    Write-through cache of stored instances of model by pk. Instances are put into cache after saving
+    and removed after deleting, copies of instances are returned, so they could be changed by caller.
+    Inside transaction instances are removed from cache at once and put into it only after commit.
+    '''
+    def contribute_to_model(self, model):
+        uid = '%s.%s.%s' % (model._meta.app_label, model.__name__, id(self))
+        signals.post_save.connect(self.post_save, sender=model, weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(self.post_delete, sender=model, weak=False, dispatch_uid=uid)
+
+    def post_save(self, sender, instance, **kwargs):
+        self.set(instance)
+
+    def post_delete(self, sender, instance, using, **kwargs):
+        self.delete(sender, [instance.pk])
+        # in case instance is put into cache by another process before commit
+        on_commit(using, lambda: self.delete(sender, [instance.pk]))
+
+    def get_values(self, instance):
+        return copy.deepcopy(dict([(field.attname, getattr(instance, field.attname))
+                                   for field in instance._meta.fields]))
+
+    def get_instance(self, model, values, using):
+        instance = model(**copy.deepcopy(values))
+        instance._state.adding = False
+        instance._state.db = using
+        return instance
+
+    def get(self, model, pk, using='default'):
+        return self.get_many(model, [pk], using).get(pk)
+
+    def get_many(self, model, pks, using='default'):
+        '''
+        Return dict of cached instances by pk
+        '''
+        return dict([(pk, self.get_instance(model, values, using))
+                     for pk, values in self.get_values_many(model, pks).items()])
+
+    def set(self, instance):
+        if instance.pk is not None:
+            model, pk, values = instance.__class__, instance.pk, self.get_values(instance)
+            if in_transaction(instance._state.db):
+                self.delete(model, [pk])
+            on_commit(instance._state.db, lambda: self.set_values(model, pk, values))
+
+    def get_values_many(self, model, pks):
+        raise NotImplementedError
+
+    def set_values(self, model, pk, values):
+        raise NotImplementedError
+
+    def delete(self, model, pks):
+        raise NotImplementedError
+
+
+class LocMemInstanceCache(InstanceCache):
+
+    '''
+    In-process LRU cache of `size` instances
+    '''
+    def __init__(self, size=1000):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_values_many(self, model, pks):
+        values = {}
+        with self.lock:
+            for pk in pks:
+                item = self.items.pop((model, pk), None)
+                if item is not None:
+                    self.items[(model, pk)] = values[pk] = item
+        return values
+
+    def set_values(self, model, pk, values):
+        with self.lock:
+            self.items.pop((model, pk), None)
+            self.items[(model, pk)] = values
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, model, pks):
+        with self.lock:
+            for pk in pks:
+                self.items.pop((model, pk), None)
+
+
+class DjangoInstanceCache(InstanceCache):
+
+    '''
+    Cache of instances in Django cache for `timeout` seconds, shared between processes
+    '''
+    key = 'odnoklassniki_api.instance.%s.%s'
+
+    def __init__(self, timeout=60 * 60):
+        self.timeout = timeout
+
+    def get_key(self, model, pk):
+        return self.key % (model._meta.db_table, pk)
+
+    def get_values_many(self, model, pks):
+        keys = dict([(self.get_key(model, pk), pk) for pk in pks])
+        return dict([(keys[key], values) for key, values in cache.get_many(keys.keys()).items()])
+
+    def set_values(self, model, pk, values):
+        cache.set(self.get_key(model, pk), values, self.timeout)
+
+    def delete(self, model, pks):
+        cache.delete_many([self.get_key(model, pk) for pk in pks])
+
+
+def get_instance_cache(model):
+    '''
+    Return instance cache of model's remote manager or None if it's not enabled
+    '''
+    return getattr(getattr(model, 'remote', None), 'instance_cache', None)
+
+
+def invalidate_instances(model, pks):
+    '''
+    Remove instances from cache after updating them in DB without saving, e.g. by QuerySet.update()
+    '''
+    instance_cache = get_instance_cache(model)
+    if instance_cache is not None:
+        instance_cache.delete(model, pks)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Maintain partitions of tables of Odnoklassniki timeline models on PostgreSQL'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--setup', action='store_true', dest='setup', default=False,
+                    help='Convert table into partitioned one'),
+        make_option('--ahead', action='store', type='int', dest='ahead', default=3,
+                    help='Number of upcoming partitions to create'),
+        make_option('--detach-days', action='store', type='int', dest='detach_days', default=None,
+                    help='Detach partitions older than this number of days'),
+        make_option('--schema', action='store', dest='schema', default=None,
+                    help='Schema for archiving of detached partitions'),
+        make_option('--drop', action='store_true', dest='drop', default=False,
+                    help='Drop detached partitions'),
+    )
+
+    def handle(self, *args, **options):
+        for label in args:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError("Model should be specified as app_label.ModelName, not '%s'" % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError("Model '%s' not found" % label)
+            partitions = model.remote.get_partitions() if hasattr(model.remote, 'get_partitions') else None
+            if partitions is None:
+                raise CommandError("Partitioning of model '%s' is not enabled" % label)
+
+            if options['setup'] and partitions.setup(options['ahead']):
+                self.stdout.write('Table of %s is partitioned\n' % label)
+            names = partitions.create_partitions(options['ahead'])
+            self.stdout.write('Partitions of %s: %s\n' % (label, ', '.join(names)))
+
+            if options['detach_days'] is not None:
+                names = partitions.detach_partitions(timezone.now() - timedelta(options['detach_days']),
+                                                     schema=options['schema'], drop=options['drop'])
+                self.stdout.write('Detached partitions of %s: %s\n' % (label, ', '.join(names) or 'none'))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from odnoklassniki_api.workqueue import WorkQueue
+
+
+class Command(BaseCommand):
+    help = 'Execute jobs of Odnoklassniki fetching work queue'
+    args = '[queue ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--lease-seconds', action='store', type='int', dest='lease_seconds', default=300,
+                    help='Seconds, after that job of crashed worker is executed by another one'),
+        make_option('--max-attempts', action='store', type='int', dest='max_attempts', default=3,
+                    help='Max number of attempts to execute job'),
+        make_option('--retry-seconds', action='store', type='int', dest='retry_seconds', default=60,
+                    help='Delay before repeating of failed job, multiplied by number of attempts'),
+        make_option('--limit', action='store', type='int', dest='limit', default=None,
+                    help='Max number of jobs executed by one run'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Run as worker, executing jobs forever'),
+        make_option('--interval', action='store', type='int', dest='interval', default=10,
+                    help='Seconds to sleep in worker mode when queue is empty'),
+        make_option('--progress', action='store_true', dest='progress', default=False,
+                    help='Show progress of queue instead of executing jobs'),
+    )
+
+    def handle(self, *args, **options):
+        queues = [WorkQueue(name, lease_seconds=options['lease_seconds'], max_attempts=options['max_attempts'],
+                            retry_seconds=options['retry_seconds']) for name in args or ['default']]
+
+        if options['progress']:
+            for queue in queues:
+                progress = queue.progress()
+                self.stdout.write('%s: %.1f%% of ids, jobs %s, fetched %d objects\n' % (
+                    queue.name, progress['percent'], progress['jobs'], progress['fetched']))
+        elif options['loop']:
+            while True:
+                if not sum([queue.work(limit=options['limit']) for queue in queues]):
+                    time.sleep(options['interval'])
+        else:
+            for queue in queues:
+                count = queue.work(limit=options['limit'])
+                self.stdout.write('Executed %d jobs of queue %s\n' % (count, queue.name))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from odnoklassniki_api.scheduler import RefreshScheduler
+
+
+class Command(BaseCommand):
+    help = 'Refresh stale objects of Odnoklassniki models'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--timeout-days', action='store', type='int', dest='timeout_days', default=1,
+                    help='Number of days, after that object is supposed to be stale'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=100,
+                    help='Number of objects refreshed by one batch'),
+        make_option('--limit', action='store', type='int', dest='limit', default=1000,
+                    help='Max number of stale objects of each model selected at once'),
+        make_option('--calls-per-second', action='store', type='float', dest='calls_per_second', default=None,
+                    help='API calls budget'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Run as worker, refreshing objects forever'),
+        make_option('--interval', action='store', type='int', dest='interval', default=60,
+                    help='Seconds to sleep in worker mode when nothing to refresh'),
+    )
+
+    def handle(self, *args, **options):
+        models = []
+        for label in args:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError("Model should be specified as app_label.ModelName, not '%s'" % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError("Model '%s' not found" % label)
+            models += [model]
+
+        scheduler = RefreshScheduler(models=models, timeout_days=options['timeout_days'],
+                                     batch_size=options['batch_size'], limit=options['limit'],
+                                     calls_per_second=options['calls_per_second'])
+        if options['loop']:
+            scheduler.run(interval=options['interval'])
+        else:
+            count = scheduler.run_once()
+            self.stdout.write('Refreshed %d objects\n' % count)
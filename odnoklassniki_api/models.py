@@ -4,25 +4,51 @@ import re
 from abc import abstractmethod
 from datetime import date, datetime
 
+import django
 import pytz
+from annoying.fields import JSONField
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.db import IntegrityError, models, transaction
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.utils.six import string_types
+from picklefield.fields import PickledObjectField
 
 from . import fields
-from .api import OdnoklassnikiError, api_call
 from .decorators import atomic
-from .fields_api import API_REQUEST_FIELDS
+from .parallel import parse_values_in_pool
+from .graph import EmbeddedObjectsGraph
+from .instance_cache import commit_cached, invalidate_instances
 from .exceptions import OdnoklassnikiContentError, OdnoklassnikiDeniedAccessError, OdnoklassnikiParseError
+from .records import get_record_class
+from .scheduler import PRIORITY_HIGH, register_access, register_accesses
+from .utils import get_resource_hash, list_chunks_iterator
 
 log = logging.getLogger('odnoklassniki_api')
 
-COMMIT_REMOTE = getattr(settings, 'ODNOKLASSNIKI_API_COMMIT_REMOTE', True)
-MASTER_DATABASE = getattr(settings, 'ODNOKLASSNIKI_API_MASTER_DATABASE', 'default')
+
+def get_commit_remote():
+    return getattr(settings, 'ODNOKLASSNIKI_API_COMMIT_REMOTE', True)
+
+
+def get_master_database():
+    return getattr(settings, 'ODNOKLASSNIKI_API_MASTER_DATABASE', 'default')
+
+# names of previous versions, settings are read by functions above, so they could be overridden in tests
+COMMIT_REMOTE = get_commit_remote()
+MASTER_DATABASE = get_master_database()
+
+
+class LazyRequestFields(object):
+
+    '''
+    Table of request fields, that is imported on first access and could be overridden in subclass or instance
+    '''
+    def __get__(self, instance, owner):
+        from .fields_api import API_REQUEST_FIELDS
+        return API_REQUEST_FIELDS
 
 
 class OdnoklassnikiManager(models.Manager):
@@ -30,26 +56,108 @@ class OdnoklassnikiManager(models.Manager):
     '''
     Odnoklassniki Ads API Manager for RESTful CRUD operations
     '''
-    fields = API_REQUEST_FIELDS
+    fields = LazyRequestFields()
+
+    # argument of fetch method with list of ids, that could be merged by refresh_many() from refresh_kwargs
+    refresh_ids_argument = 'ids'
+    refresh_items_limit = 100
 
     def get_request_fields(self, *args, **kwargs):
+        '''
+        Return comma-separated string of fields for request of objects `args`.
+        Kwargs:
+         * `prefix` - prefix each field with name of object, like 'group.name'.
+         * `model_fields` - request only fields, that are stored in fields of model.
+        '''
+        key = (args, bool(kwargs.get('prefix', False)), bool(kwargs.get('model_fields', False)))
+        try:
+            return self._request_fields_cache[key]
+        except AttributeError:
+            self._request_fields_cache = {}
+        except KeyError:
+            pass
+
+        if kwargs.get('model_fields', False):
+            model_fields = self.get_model_field_names()
+
         fields = []
         for arg in args:
             for field in self.fields.get(arg, ''):
+                if kwargs.get('model_fields', False) and field not in model_fields:
+                    continue
                 if kwargs.get('prefix', False):
                     field = '%s.%s' % (arg, field)
-                fields += [field]
-        return ','.join(fields)
+                if field not in fields:
+                    fields += [field]
 
-    def __init__(self, methods=None, remote_pk=None, *args, **kwargs):
+        self._request_fields_cache[key] = ','.join(fields)
+        return self._request_fields_cache[key]
+
+    def get_model_field_names(self):
+        names = set()
+        for field in self.model._meta.fields:
+            names.update([field.name, field.attname])
+        if self.model.remote_pk_local_field in names:
+            names.add(self.model.remote_pk_field)
+        return names
+
+    def __init__(self, methods=None, remote_pk=None, skip_unchanged=False, instance_cache=None, *args, **kwargs):
         if methods and len(methods.items()) < 1:
             raise ValueError('Argument methods must contains at least 1 specified method')
 
         self.methods = methods or {}
         self.remote_pk = remote_pk or ('id',)
+        # don't parse and save resources with the same hash, as stored object has
+        self.skip_unchanged = skip_unchanged
+        # LocMemInstanceCache or DjangoInstanceCache of stored instances for reading them by pk without DB
+        self.instance_cache = instance_cache
 
         super(OdnoklassnikiManager, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, model, name):
+        super(OdnoklassnikiManager, self).contribute_to_class(model, name)
+        self.name = name
+        if self.instance_cache is not None:
+            self.instance_cache.contribute_to_model(model)
+
+    def get_instance(self, pk, using=None):
+        '''
+        Return stored instance by pk from instance cache or DB
+        '''
+        if self.instance_cache is not None:
+            try:
+                pk = self.model._meta.pk.to_python(pk)
+            except ValidationError:
+                pass
+            else:
+                instance = self.instance_cache.get(self.model, pk, using or 'default')
+                if instance is not None:
+                    register_access(instance)
+                    return instance
+
+        instance = self.model.objects.using(using).get(pk=pk)
+        if self.instance_cache is not None:
+            self.instance_cache.set(instance)
+        register_access(instance)
+        return instance
+
+    def get_instances(self, pks, using=None):
+        '''
+        Return dict of stored instances by pk from instance cache or DB
+        '''
+        instances = {}
+        if self.instance_cache is not None:
+            instances = self.instance_cache.get_many(self.model, pks, using or 'default')
+        missed = [pk for pk in pks if pk not in instances]
+        if missed:
+            stored = self.model.objects.using(using).in_bulk(missed)
+            if self.instance_cache is not None:
+                for instance in stored.values():
+                    self.instance_cache.set(instance)
+            instances.update(stored)
+        register_accesses(self.model, instances.keys())
+        return instances
+
     def get_by_url(self, url):
         '''
         Return existed User, Group, Application by url or new intance with empty pk
@@ -64,8 +172,10 @@ class OdnoklassnikiManager(models.Manager):
             assert self.model.slug_prefix and slug.startswith(self.model.slug_prefix)
             id = int(re.findall(r'^%s(\d+)$' % self.model.slug_prefix, slug)[0])
         except (AssertionError, ValueError, IndexError):
+            from .api import OdnoklassnikiError, api_call
             try:
-                response = api_call('url.getInfo', url=url)
+                # url is resolved for user, who is waiting for it
+                response = api_call('url.getInfo', url=url, priority=PRIORITY_HIGH)
                 assert self.model.resolve_screen_name_type == response['type']
                 id = int(response['objectId'])
             except OdnoklassnikiError, e:
@@ -80,7 +190,7 @@ class OdnoklassnikiManager(models.Manager):
                 return None
 
         try:
-            object = self.model.objects.get(id=id)
+            object = self.get_instance(id)
         except self.model.DoesNotExist:
             object = self.model(id=id)  # , shortname=slug)
 
@@ -91,7 +201,23 @@ class OdnoklassnikiManager(models.Manager):
         # return
         # self.model.objects.filter(pk__in={self.get_or_create_from_instance(instance).pk
         # for instance in instances})
-        return self.model.objects.filter(pk__in=set([self.get_or_create_from_instance(instance).pk for instance in instances]))
+        EmbeddedObjectsGraph(using=get_master_database()).add_many(instances).save()
+
+        pks = set()
+        unchanged = {}
+        for instance in instances:
+            if getattr(instance, '_unchanged', False):
+                unchanged.setdefault(instance.fetched, []).append(instance.pk)
+            else:
+                pks.add(self.get_or_create_from_instance(instance).pk)
+
+        # unchanged objects are updated in bulk with new time of fetching
+        for fetched, unchanged_pks in unchanged.items():
+            self.model.objects.using(get_master_database()).filter(pk__in=unchanged_pks).update(fetched=fetched)
+            invalidate_instances(self.model, unchanged_pks)
+            pks.update(unchanged_pks)
+
+        return self.model.objects.filter(pk__in=pks)
 
     def get_or_create_from_resources_list(self, response_list, extra_fields=None):
         instances = self.parse_response_list(response_list, extra_fields)
@@ -99,13 +225,29 @@ class OdnoklassnikiManager(models.Manager):
 
     def get_or_create_from_instance(self, instance):
 
+        if getattr(instance, '_unchanged', False):
+            queryset = self.model.objects.using(get_master_database()).filter(pk=instance.pk)
+            partition_lookup = self.get_partition_lookup(instance)
+            # object is searched in all partitions, if date of stored object differs
+            if not partition_lookup or not queryset.filter(**partition_lookup).update(fetched=instance.fetched):
+                queryset.update(fetched=instance.fetched)
+            invalidate_instances(self.model, [instance.pk])
+            return instance
+
+        EmbeddedObjectsGraph(using=get_master_database()).add_many([instance]).save()
+
         remote_pk_dict = {}
         for field_name in self.remote_pk:
             remote_pk_dict[field_name] = getattr(instance, field_name)
 
         if remote_pk_dict:
+            partition_lookup = self.get_partition_lookup(instance)
             try:
-                old_instance = self.model.objects.using(MASTER_DATABASE).get(**remote_pk_dict)
+                # instance cache is not used, because it could be stale in comparison with master
+                if partition_lookup:
+                    old_instance = self.get_partitioned_instance(remote_pk_dict, partition_lookup)
+                else:
+                    old_instance = self.model.objects.using(get_master_database()).get(**remote_pk_dict)
                 instance._substitute(old_instance)
                 instance.save()
             except self.model.DoesNotExist:
@@ -117,14 +259,33 @@ class OdnoklassnikiManager(models.Manager):
 
         return instance
 
+    def get_partitioned_instance(self, remote_pk_dict, partition_lookup):
+        '''
+        Return stored instance from partition of instance or, if date of stored object differs, from any partition
+        '''
+        queryset = self.model.objects.using(get_master_database())
+        try:
+            return queryset.get(**dict(remote_pk_dict, **partition_lookup))
+        except self.model.DoesNotExist:
+            return queryset.get(**remote_pk_dict)
+
+    def get_partition_lookup(self, instance):
+        '''
+        Return lookup of partition of instance, that is added to queries of stored instance by pk
+        '''
+        return {}
+
     def get_or_create_from_resource(self, resource):
 
         instance = self.model()
+        instance.resource_hash = self.get_resource_hash(resource)
         instance.parse(dict(resource))
 
         return self.get_or_create_from_instance(instance)
 
     def api_call(self, method='get', **kwargs):
+        from .api import api_call
+
         if self.model.methods_access_tag:
             kwargs['methods_access_tag'] = self.model.methods_access_tag
 
@@ -137,12 +298,48 @@ class OdnoklassnikiManager(models.Manager):
     def fetch_one(self, *args, **kwargs):
         return self.fetch(*args, **kwargs)
 
+    def refresh_many(self, instances):
+        '''
+        Refresh queryset or list of instances with remote data and update them in place.
+        Instances with the same `refresh_kwargs`, except list of ids in `refresh_ids_argument`,
+        are fetched together by chunks of `refresh_items_limit`, others are refreshed one by one
+        '''
+        groups = {}
+        for instance in instances:
+            kwargs = dict(instance.refresh_kwargs)
+            ids = kwargs.pop(self.refresh_ids_argument, None)
+            if not isinstance(ids, (list, tuple)):
+                instance.refresh()
+                continue
+            key = repr(sorted(kwargs.items()))
+            groups.setdefault(key, (kwargs, []))[1].append((ids, instance))
+
+        for kwargs, items in groups.values():
+            instances_by_pk = dict([(instance.pk, instance) for ids, instance in items])
+            ids = [id for ids, instance in items for id in ids]
+            for chunk in list_chunks_iterator(ids, self.refresh_items_limit):
+                kwargs[self.refresh_ids_argument] = chunk
+                result = self.fetch_one(**kwargs)
+                if isinstance(result, models.Model):
+                    result = [result]
+                for new_instance in result:
+                    instance = instances_by_pk.pop(new_instance.pk, None)
+                    if instance is not None:
+                        instance.__dict__.update(new_instance.__dict__)
+
+            if instances_by_pk:
+                log.warning("Remote server didn't return %d objects of %s while refreshing, pks: %s" %
+                            (len(instances_by_pk), self.model.__name__, instances_by_pk.keys()))
+
+    @commit_cached
     @atomic
     def fetch(self, *args, **kwargs):
         '''
         Retrieve and save object to local DB
         '''
-        result = self.get(*args, **kwargs)
+        return self.save_parsed(self.get(*args, **kwargs))
+
+    def save_parsed(self, result):
         if isinstance(result, list):
             return self.get_or_create_from_instances_list(result)
         elif isinstance(result, QuerySet):
@@ -150,6 +347,14 @@ class OdnoklassnikiManager(models.Manager):
         else:
             return self.get_or_create_from_instance(result)
 
+    @commit_cached
+    @atomic
+    def save_response(self, response, extra_fields=None):
+        '''
+        Parse raw response and save objects to local DB, used for replaying archived responses
+        '''
+        return self.save_parsed(self.parse_response(response, extra_fields))
+
     def get(self, *args, **kwargs):
         '''
         Retrieve objects from remote server
@@ -159,10 +364,17 @@ class OdnoklassnikiManager(models.Manager):
         extra_fields['fetched'] = datetime.utcnow().replace(tzinfo=timezone.utc)
 
         self.response = self.api_call(*args, **kwargs)
-
         if self.response == {}:
             raise OdnoklassnikiContentError()
 
+        from .archive import get_archive
+
+        archive = get_archive()
+        if archive:
+            method = args[0] if args else kwargs.get('method', 'get')
+            archive.append(self.model, method, dict([(k, v) for k, v in kwargs.items() if k != 'method']),
+                           self.response, extra_fields['fetched'], extra_fields)
+
         return self.parse_response(self.response, extra_fields)
 
     def parse_response(self, response, extra_fields=None):
@@ -180,13 +392,101 @@ class OdnoklassnikiManager(models.Manager):
         # important to do it before calling parse method
         if extra_fields:
             instance.__dict__.update(extra_fields)
+        # resource could be changed by parse method
+        resource_hash = self.get_resource_hash(resource, extra_fields)
         instance.parse(resource)
+        instance.resource_hash = resource_hash
 
         return instance
 
     def parse_response_list(self, response_list, extra_fields=None):
+        return list(self.iter_response_list(response_list, extra_fields))
 
+    def parse_response_records(self, response_list, extra_fields=None):
+        '''
+        Generator of compact records instead of instances for bulk ingestion of big responses.
+        Records could be converted back by `record.to_instance()` or saved by `bulk_create_records()`
+        '''
+        record_class = get_record_class(self.model)
+        for instance in self.iter_response_list(response_list, extra_fields):
+            yield record_class.from_instance(instance)
+
+    def bulk_create_records(self, records, batch_size=1000):
         instances = []
+        for record in records:
+            instances += [record.to_instance()]
+            if len(instances) == batch_size:
+                self.bulk_create_instances(instances)
+                instances = []
+        if instances:
+            self.bulk_create_instances(instances)
+
+    def bulk_create_instances(self, instances):
+        using = get_master_database()
+        EmbeddedObjectsGraph(using=using).add_many(instances).save()
+        self.model.objects.using(using).bulk_create(instances)
+        fields.update_multi_value_tables(self.model, instances, using)
+
+    def iter_response_list(self, response_list, extra_fields=None):
+        resources = self.iter_response_resources(response_list)
+        if self.skip_unchanged and self.model._meta.pk.name == self.model.remote_pk_local_field:
+            resources = list(resources)
+            unchanged = self.get_unchanged_instances(resources, extra_fields)
+        else:
+            unchanged = {}
+
+        for resource in resources:
+            instance = unchanged.get(self.get_resource_pk(resource))
+            yield instance if instance is not None else self.parse_response_dict(resource, extra_fields)
+
+    def get_resource_hash(self, resource, extra_fields=None):
+        '''
+        Return hash of resource for detection of unchanged objects, if `skip_unchanged` is enabled
+        '''
+        return self.calculate_resource_hash(resource, extra_fields) if self.skip_unchanged else ''
+
+    def calculate_resource_hash(self, resource, extra_fields=None):
+        '''
+        Return hash of resource, that depends on fields of model and it's `parse_version` as well,
+        so resources are parsed again after changing of model
+        '''
+        schema = [self.model._meta.app_label, self.model.__name__, self.model.parse_version,
+                  sorted([field.attname for field in self.model._meta.fields])]
+        return get_resource_hash(resource, extra_fields, schema)
+
+    def get_resource_pk(self, resource):
+        try:
+            return self.model._meta.pk.to_python(resource.get(self.model.remote_pk_field))
+        except ValidationError:
+            return None
+
+    def get_unchanged_instances(self, resources, extra_fields=None, batch_size=1000):
+        '''
+        Return dict of stored instances by pk, that have the same hash, as resources in response.
+        Instances are marked as unchanged with time of fetching from `extra_fields`
+        '''
+        hashes = {}
+        for resource in resources:
+            pk = self.get_resource_pk(resource)
+            if pk is not None:
+                hashes[pk] = self.calculate_resource_hash(resource, extra_fields)
+
+        unchanged = []
+        for chunk in list_chunks_iterator(hashes.keys(), batch_size):
+            unchanged += [pk for pk, resource_hash in self.model.objects.using(get_master_database()).filter(pk__in=chunk)
+                          .values_list('pk', 'resource_hash') if hashes[pk] == resource_hash]
+
+        instances = {}
+        for chunk in list_chunks_iterator(unchanged, batch_size):
+            instances.update(self.model.objects.using(get_master_database()).in_bulk(chunk))
+        for instance in instances.values():
+            instance._unchanged = True
+            if extra_fields and 'fetched' in extra_fields:
+                instance.fetched = extra_fields['fetched']
+        return instances
+
+    def iter_response_resources(self, response_list):
+
         for resource in response_list:
 
             # in response with stats there is extra array inside each element
@@ -204,11 +504,64 @@ class OdnoklassnikiManager(models.Manager):
                 log.error("Resource %s is not dictionary" % resource)
                 raise e
 
-            instance = self.parse_response_dict(resource, extra_fields)
+            yield resource
+
+    def parse_response_list_parallel(self, response_list, extra_fields=None, processes=None, chunksize=100,
+                                     pool=None):
+        '''
+        Parse big response in pool of processes by `Model.parse_values()`, related objects are fetched
+        from DB by batches in current process. Custom logic of `Model.parse()` is not applied,
+        so it should be used for models, that parse response by `parse_values()` only
+        '''
+        resources = list(self.iter_response_resources(response_list))
+        values_list = parse_values_in_pool(self.model, resources, processes, chunksize, pool)
+        related_instances = self.get_related_instances(values_list)
+
+        instances = []
+        for resource, values in zip(resources, values_list):
+            instance = self.model()
+            if extra_fields:
+                instance.__dict__.update(extra_fields)
+            for key, value in values.items():
+                if key in related_instances and value:
+                    key, value = instance.parse_related(self.model._meta.get_field(key), key, value,
+                                                        related_instances[key])
+                setattr(instance, key, value)
+            instance.resource_hash = self.get_resource_hash(resource, extra_fields)
             instances += [instance]
 
         return instances
 
+    def get_related_instances(self, values_list, batch_size=1000):
+        '''
+        Return dict of related instances by foreign key name and it's value in response
+        '''
+        related_instances = {}
+        for field in self.model._meta.fields:
+            if not isinstance(field, (models.OneToOneField, models.ForeignKey)):
+                continue
+
+            rel_class = field.rel.to
+            pks = {}
+            for values in values_list:
+                value = values.get(field.name)
+                if value and not isinstance(value, dict) and value not in pks:
+                    try:
+                        pks[value] = rel_class._meta.pk.to_python(value)
+                    except ValidationError:
+                        pass
+
+            instances = {}
+            for chunk in list_chunks_iterator(list(set(pks.values())), batch_size):
+                if isinstance(getattr(rel_class, 'remote', None), OdnoklassnikiManager):
+                    instances.update(rel_class.remote.get_instances(chunk))
+                else:
+                    instances.update(rel_class.objects.in_bulk(chunk))
+
+            related_instances[field.name] = dict([(value, instances[pk]) for value, pk in pks.items()
+                                                  if pk in instances])
+        return related_instances
+
 
 class OdnoklassnikiTimelineManager(OdnoklassnikiManager):
 
@@ -217,10 +570,47 @@ class OdnoklassnikiTimelineManager(OdnoklassnikiManager):
     '''
     timeline_cut_fieldname = 'date'
     timeline_force_ordering = True
+    # interval of partitions of table by `timeline_cut_fieldname` on PostgreSQL: 'day', 'week', 'month', 'year'
+    timeline_partition_interval = None
+
+    def __init__(self, *args, **kwargs):
+        if 'partition_interval' in kwargs:
+            self.timeline_partition_interval = kwargs.pop('partition_interval')
+        if self.timeline_partition_interval and django.VERSION < (1, 6):
+            raise ImproperlyConfigured("Partitioning of timeline models requires Django 1.6+ for routing of updates")
+        super(OdnoklassnikiTimelineManager, self).__init__(*args, **kwargs)
+
+    def get_partitions(self):
+        '''
+        Return TimelinePartitions of table of model or None if partitioning is disabled
+        '''
+        from .partitions import TimelinePartitions
+        if not self.timeline_partition_interval:
+            return None
+        return TimelinePartitions(self.model, self.timeline_cut_fieldname, self.timeline_partition_interval,
+                                  using=get_master_database())
+
+    def get_partition_lookup(self, instance):
+        value = getattr(instance, self.timeline_cut_fieldname, None)
+        if not self.timeline_partition_interval or value is None:
+            return {}
+        return {self.timeline_cut_fieldname: value}
+
+    def get_timeline_queryset(self, after=None, before=None):
+        '''
+        Return stored objects between dates `after` and `before`, only matching partitions are scanned
+        '''
+        queryset = self.model.objects.all()
+        if after:
+            queryset = queryset.filter(**{'%s__gte' % self.timeline_cut_fieldname: after})
+        if before:
+            queryset = queryset.filter(**{'%s__lte' % self.timeline_cut_fieldname: before})
+        return queryset
 
     def get_timeline_date(self, instance):
         return getattr(instance, self.timeline_cut_fieldname, datetime(1970, 1, 1).replace(tzinfo=timezone.utc))
 
+    @commit_cached
     @atomic
     def get(self, *args, **kwargs):
         '''
@@ -272,9 +662,24 @@ class OdnoklassnikiModel(models.Model):
     slug_prefix = ''
 
     fetched = models.DateTimeField(u'Обновлено', null=True, blank=True, db_index=True)
+    resource_hash = models.CharField(u'Хеш ответа API', max_length=32, blank=True, editable=False)
+
+    # should be increased after changing of parse(), so unchanged resources are parsed again
+    parse_version = 1
 
     objects = models.Manager()
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # update of partitioned table is routed into partition of instance,
+        # if date of stored object differs, row is updated in any partition and moved by PostgreSQL
+        remote = getattr(self.__class__, 'remote', None)
+        partition_lookup = remote.get_partition_lookup(self) if isinstance(remote, OdnoklassnikiManager) else {}
+        if partition_lookup and super(OdnoklassnikiModel, self)._do_update(
+                base_qs.filter(**partition_lookup), using, pk_val, values, update_fields, forced_update):
+            return True
+        return super(OdnoklassnikiModel, self)._do_update(base_qs, using, pk_val, values, update_fields,
+                                                          forced_update)
+
     def _substitute(self, old_instance):
         '''
         Substitute new instance with old one while updating in method Manager.get_or_create_from_instance()
@@ -282,29 +687,39 @@ class OdnoklassnikiModel(models.Model):
         '''
         self.pk = old_instance.pk
 
-        # substitute all valueble fields fom old_instance
+        # substitute all valueble fields fom old_instance, except hash of response, that belongs to new one
         for key, old_value in old_instance.__dict__.items():
+            if key == 'resource_hash':
+                continue
             new_value = getattr(self, key)
             if old_value and (new_value is None or new_value == ''):
                 setattr(self, key, old_value)
 
-    def parse(self, response):
+    @classmethod
+    def parse_values(cls, response):
         '''
-        Parse API response and define fields with values
+        Parse API response and return dict of field names and values. Related objects are not resolved,
+        so method doesn't touch DB and could be executed in another process
         '''
+        values = {}
         for key, value in response.items():
             key = key.lower()
-            if key == self.remote_pk_field:
-                key = self.remote_pk_local_field
+            if key == cls.remote_pk_field:
+                key = cls.remote_pk_local_field
 #                value = int(value)
 
             try:
-                field = self._meta.get_field(key)
+                field = cls._meta.get_field(key)
             except FieldDoesNotExist:
-                log.debug('Field with name "%s" doesn\'t exists in the model %s' % (key, self.__class__.__name__))
+                log.debug('Field with name "%s" doesn\'t exists in the model %s' % (key, cls.__name__))
                 continue
 
-            if isinstance(field, models.IntegerField) and value:
+            if isinstance(field, fields.MultiValueField):
+                if isinstance(value, string_types):
+                    value = [item for item in value.split(',') if item]
+                elif not isinstance(value, (list, tuple)):
+                    value = [value] if value is not None else []
+            elif isinstance(field, models.IntegerField) and value:
                 try:
                     value = int(value)
                 except:
@@ -347,21 +762,52 @@ class OdnoklassnikiModel(models.Model):
                     except:
                         value = None
 
-            if isinstance(field, (models.OneToOneField, models.ForeignKey)) and value:
-                rel_class = field.rel.to
-                if isinstance(value, dict):
-                    value = rel_class().parse(dict(value))
-                else:
-                    try:
-                        value = rel_class.objects.get(pk=value)
-                    except rel_class.DoesNotExist:
-                        key = key + '_id'
-
             if isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)) and isinstance(value, list):
                 value = ','.join([unicode(v) for v in value])
 
+            values[key] = value
+        return values
+
+    def parse(self, response):
+        '''
+        Parse API response and define fields with values
+        '''
+        for key, value in self.parse_values(response).items():
+            field = self._meta.get_field(key)
+            if isinstance(field, (models.OneToOneField, models.ForeignKey)) and value:
+                key, value = self.parse_related(field, key, value)
             setattr(self, key, value)
 
+    def parse_related(self, field, key, value, related_instances=None):
+        '''
+        Return attribute name and value for related object from response.
+        `related_instances` - dict of already fetched from DB related instances by pk
+        '''
+        rel_class = field.rel.to
+        if isinstance(value, dict):
+            # embedded object is saved before instance by EmbeddedObjectsGraph
+            resource = dict(value)
+            value = rel_class()
+            remote = getattr(rel_class, 'remote', None)
+            value.resource_hash = remote.get_resource_hash(resource) \
+                if isinstance(remote, OdnoklassnikiManager) else ''
+            value.parse(resource)
+            value._embedded = True
+        elif related_instances is not None:
+            if value in related_instances:
+                value = related_instances[value]
+            else:
+                key = key + '_id'
+        else:
+            try:
+                if isinstance(getattr(rel_class, 'remote', None), OdnoklassnikiManager):
+                    value = rel_class.remote.get_instance(value)
+                else:
+                    value = rel_class.objects.get(pk=value)
+            except rel_class.DoesNotExist:
+                key = key + '_id'
+        return key, value
+
     def refresh(self):
         """
         Refresh current model with remote data
@@ -400,3 +846,49 @@ class OdnoklassnikiPKModel(OdnoklassnikiModel):
     @property
     def slug(self):
         return '/'.join([self.slug_prefix, str(self.pk)])
+
+
+class FetchJob(models.Model):
+
+    '''
+    Job of distributed work queue: chunk of ids for fetching by method of manager.
+    Jobs are created by methods, decorated with `fetch_by_chunks_of`, called with argument `queue`,
+    and are executed by workers of `workqueue.WorkQueue`
+    '''
+    class Meta:
+        verbose_name = u'Задание загрузки'
+        verbose_name_plural = u'Задания загрузки'
+        # index_together is supported since Django 1.5
+        if django.VERSION >= (1, 5):
+            index_together = [('queue', 'status', 'lease_until')]
+
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = (
+        (PENDING, u'В очереди'),
+        (RUNNING, u'Выполняется'),
+        (DONE, u'Выполнено'),
+        (FAILED, u'Ошибка'),
+    )
+
+    queue = models.CharField(u'Очередь', max_length=100)
+    model = models.CharField(u'Модель', max_length=100)
+    manager = models.CharField(u'Менеджер', max_length=100, default='remote')
+    method = models.CharField(u'Метод', max_length=100)
+    ids_argument = models.CharField(u'Аргумент идентификаторов', max_length=100, default='ids')
+    ids = JSONField(u'Идентификаторы')
+    ids_count = models.PositiveIntegerField(u'Количество идентификаторов')
+    kwargs = PickledObjectField(u'Аргументы', default=dict)
+
+    status = models.CharField(u'Статус', max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(u'Попыток', default=0)
+    lease_until = models.DateTimeField(u'Занято до', null=True, blank=True)
+    worker = models.CharField(u'Обработчик', max_length=100, blank=True)
+    fetched_count = models.PositiveIntegerField(u'Загружено объектов', default=0)
+    error = models.TextField(u'Ошибка', blank=True)
+
+    created = models.DateTimeField(u'Создано', auto_now_add=True)
+    updated = models.DateTimeField(u'Изменено', auto_now=True)
+
+    def __unicode__(self):
+        return u'%s.%s() of %d ids in queue %s' % (self.model, self.method, self.ids_count, self.queue)
+
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import atexit
+import threading
+
+from django.db import connections
+from django.db.models import get_model
+
+__all__ = ['parse_values_in_pool', 'get_pool']
+
+_pools = {}
+_pools_lock = threading.Lock()
+# connections, inherited from parent process, they are never closed or garbage collected in child process
+_inherited_connections = []
+
+
+def parse_values_worker(args):
+    model_label, resource = args
+    return get_model(*model_label.split('.')).parse_values(resource)
+
+
+def reset_connections():
+    '''
+    Initializer of forked process: forget connections to DB, inherited from parent process, without closing them,
+    because closing would terminate sessions of parent process, that could be inside transaction.
+    Inherited connections are kept referenced, otherwise their deallocation closes them as well
+    '''
+    for connection in connections.all():
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+        connection.connection = None
+
+
+def get_pool(processes=None):
+    '''
+    Return shared pool of `processes`, it's created on the first call and closed on exit
+    '''
+    from multiprocessing import Pool
+
+    with _pools_lock:
+        if processes not in _pools:
+            _pools[processes] = Pool(processes, initializer=reset_connections)
+        return _pools[processes]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+            pool.join()
+        _pools.clear()
+
+
+def parse_values_in_pool(model, resources, processes=None, chunksize=100, pool=None):
+    '''
+    Parse list of resources into dicts of field values by `model.parse_values()` in pool of processes.
+    If `pool` is not specified, shared pool of `processes` is used
+    '''
+    model_label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+    tasks = [(model_label, resource) for resource in resources]
+    return (pool or get_pool(processes)).map(parse_values_worker, tasks, chunksize)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import date, datetime, timedelta
+
+from django.db import connections, models, router
+from django.utils import timezone
+
+from .decorators import atomic
+
+__all__ = ['TimelinePartitions']
+
+log = logging.getLogger('odnoklassniki_api')
+
+
+class TimelinePartitions(object):
+
+    '''
+    Range partitioning of table of timeline model by date field on PostgreSQL 11+.
+    Partitions are named `<table>_p<start>` and cover one `interval`: 'day', 'week', 'month' or 'year',
+    rows with empty date or out of created partitions are stored in partition `<table>_default`.
+    Queries with conditions on date field are pruned to matching partitions by PostgreSQL itself.
+    Primary key of partitioned table can't be unique without date field, so:
+     * objects are searched and updated in partition of their date, if stored object has another date,
+       it's searched in all partitions;
+     * model can't have unique fields except primary key and can't be referenced by foreign keys of other tables.
+    '''
+    intervals = {
+        'day': '%Y%m%d',
+        'week': '%Y%m%d',
+        'month': '%Y%m',
+        'year': '%Y',
+    }
+
+    def __init__(self, model, fieldname, interval='month', using=None):
+        if interval not in self.intervals:
+            raise ValueError("Interval should be one of %s, not '%s'" % (', '.join(sorted(self.intervals)), interval))
+        self.model = model
+        self.fieldname = fieldname
+        self.interval = interval
+        self.using = using or router.db_for_write(model)
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    @property
+    def column(self):
+        return self.model._meta.get_field(self.fieldname).column
+
+    def qn(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def get_start(self, value):
+        '''
+        Return date of start of interval, that contains `value`
+        '''
+        if isinstance(value, datetime):
+            if timezone.is_aware(value):
+                value = value.astimezone(timezone.utc)
+            value = value.date()
+        if self.interval == 'day':
+            return value
+        elif self.interval == 'week':
+            return value - timedelta(value.weekday())
+        elif self.interval == 'month':
+            return value.replace(day=1)
+        else:
+            return value.replace(month=1, day=1)
+
+    def get_next_start(self, start):
+        if self.interval == 'day':
+            return start + timedelta(1)
+        elif self.interval == 'week':
+            return start + timedelta(7)
+        elif self.interval == 'month':
+            return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        else:
+            return date(start.year + 1, 1, 1)
+
+    def get_partition_name(self, start):
+        return '%s_p%s' % (self.table, start.strftime(self.intervals[self.interval]))
+
+    def get_bound(self, start):
+        if isinstance(self.model._meta.get_field(self.fieldname), models.DateTimeField):
+            return datetime(start.year, start.month, start.day, tzinfo=timezone.utc)
+        return start
+
+    def execute(self, sql, params=None):
+        log.debug('Partitions of %s: %s' % (self.table, sql))
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def is_partitioned(self):
+        return self.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+                            [self.table]).fetchone() is not None
+
+    def get_partitions(self):
+        '''
+        Return sorted list of (name, start) of partitions with dates
+        '''
+        prefix = '%s_p' % self.table
+        partitions = []
+        for name, in self.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                                  'WHERE i.inhparent = %s::regclass', [self.table]).fetchall():
+            if name.startswith(prefix):
+                try:
+                    start = datetime.strptime(name[len(prefix):], self.intervals[self.interval]).date()
+                except ValueError:
+                    continue
+                partitions += [(name, start)]
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    def create_partition(self, start):
+        name = self.get_partition_name(start)
+        self.execute('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (
+            self.qn(name), self.qn(self.table)), [self.get_bound(start), self.get_bound(self.get_next_start(start))])
+        return name
+
+    def create_partitions(self, ahead=3, since=None):
+        '''
+        Create partitions from interval of `since` (now by default) and `ahead` intervals after it.
+        Return names of partitions
+        '''
+        start = self.get_start(since or timezone.now())
+        end = self.get_start(timezone.now())
+        for i in range(ahead):
+            end = self.get_next_start(end)
+
+        names = []
+        while start <= end:
+            names += [self.create_partition(start)]
+            start = self.get_next_start(start)
+        return names
+
+    @atomic
+    def setup(self, ahead=3):
+        '''
+        Convert existing table into partitioned one: create partitions for dates of stored rows
+        and `ahead` intervals, copy rows and drop old table. Sequence of primary key is kept
+        '''
+        if self.is_partitioned():
+            return False
+
+        table, old_table = self.table, '%s_unpartitioned' % self.table
+        pk_column = self.model._meta.pk.column
+        self.execute('ALTER TABLE %s RENAME TO %s' % (self.qn(table), self.qn(old_table)))
+        self.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (%s)' % (
+            self.qn(table), self.qn(old_table), self.qn(self.column)))
+
+        sequence = self.execute('SELECT pg_get_serial_sequence(%s, %s)', [old_table, pk_column]).fetchone()[0]
+        if sequence:
+            # otherwise sequence is dropped together with old table
+            self.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (sequence, self.qn(table), self.qn(pk_column)))
+
+        self.execute('CREATE UNIQUE INDEX %s ON %s (%s, %s)' % (
+            self.qn('%s_pk_%s' % (table, self.column)), self.qn(table), self.qn(pk_column), self.qn(self.column)))
+        for columns in self.get_indexed_columns():
+            self.execute('CREATE INDEX %s ON %s (%s)' % (
+                self.qn('%s_%s' % (table, '_'.join(columns))), self.qn(table), ', '.join(map(self.qn, columns))))
+
+        self.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (self.qn('%s_default' % table), self.qn(table)))
+        since = self.execute('SELECT min(%s) FROM %s' % (self.qn(self.column), self.qn(old_table))).fetchone()[0]
+        self.create_partitions(ahead, since)
+
+        self.execute('INSERT INTO %s SELECT * FROM %s' % (self.qn(table), self.qn(old_table)))
+        self.execute('DROP TABLE %s' % self.qn(old_table))
+        log.info('Table %s is partitioned by %s of %s' % (table, self.interval, self.column))
+        return True
+
+    def get_indexed_columns(self):
+        '''
+        Return lists of columns of indexes of model, except primary key.
+        Unique constraints can't be kept in partitioned table without date field, so they are not allowed
+        '''
+        unique = [field.name for field in self.model._meta.local_fields if field.unique and not field.primary_key]
+        unique += [', '.join(fields) for fields in self.model._meta.unique_together]
+        if unique:
+            raise ValueError("Table of %s with unique constraints on %s can't be partitioned" %
+                             (self.model.__name__, '; '.join(unique)))
+
+        columns = [[field.column] for field in self.model._meta.local_fields
+                   if field.db_index and not field.primary_key]
+        if [self.column] not in columns:
+            columns += [[self.column]]
+        for fields in self.model._meta.index_together:
+            columns += [[self.model._meta.get_field(name).column for name in fields]]
+        return columns
+
+    @atomic
+    def detach_partitions(self, before, schema=None, drop=False):
+        '''
+        Detach partitions with dates earlier than `before` and move them into `schema`
+        for archiving or drop them. Return names of detached partitions
+        '''
+        names = []
+        for name, start in self.get_partitions():
+            if self.get_next_start(start) > self.get_start(before):
+                break
+            self.execute('ALTER TABLE %s DETACH PARTITION %s' % (self.qn(self.table), self.qn(name)))
+            if drop:
+                self.execute('DROP TABLE %s' % self.qn(name))
+            elif schema:
+                self.execute('CREATE SCHEMA IF NOT EXISTS %s' % self.qn(schema))
+                self.execute('ALTER TABLE %s SET SCHEMA %s' % (self.qn(name), self.qn(schema)))
+            names += [name]
+        return names
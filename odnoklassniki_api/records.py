@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+
+__all__ = ['get_record_class']
+
+_record_classes = {}
+
+
+class Record(object):
+
+    '''
+    Compact representation of parsed, but not saved instance of model.
+    Keeps values of concrete fields in slots, related objects, parsed from response, and non-field attributes
+    '''
+    __slots__ = ('_extra',)
+    model = None
+
+    @classmethod
+    def from_instance(cls, instance):
+        record = cls()
+        values = dict(instance.__dict__)
+        values.pop('_state', None)
+        for name in cls.__slots__:
+            if name in values:
+                setattr(record, name, values.pop(name))
+        record._extra = values or None
+        return record
+
+    def to_dict(self):
+        values = dict(self._extra or {})
+        for name in self.__slots__:
+            if name != '_extra' and hasattr(self, name):
+                values[name] = getattr(self, name)
+        return values
+
+    def to_instance(self):
+        instance = self.model()
+        instance.__dict__.update(self.to_dict())
+        return instance
+
+
+def get_record_class(model):
+    '''
+    Return Record class with slots for concrete fields of model
+    '''
+    if model not in _record_classes:
+        slots = []
+        for field in model._meta.fields:
+            slots += [field.attname]
+            if isinstance(field, (models.ForeignKey, models.OneToOneField)):
+                slots += [field.get_cache_name()]
+        _record_classes[model] = type('%sRecord' % model.__name__, (Record,), {
+            '__slots__': tuple(slots),
+            'model': model,
+        })
+    return _record_classes[model]
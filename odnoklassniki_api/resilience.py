@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from Queue import Empty, Queue
+
+__all__ = ['CircuitBreaker', 'LatencyTracker', 'hedged_call', 'fail_on_overload']
+
+_overload = threading.local()
+
+
+def is_failing_on_overload():
+    return getattr(_overload, 'value', False)
+
+
+@contextmanager
+def fail_on_overload(enabled=True):
+    '''
+    Raise errors of overloaded server for API calls of current thread inside block instead of repeating calls,
+    so caller could reduce load, e.g. by smaller chunks of ids
+    '''
+    previous = is_failing_on_overload()
+    _overload.value = enabled
+    try:
+        yield
+    finally:
+        _overload.value = previous
+
+
+class CircuitBreaker(object):
+
+    '''
+    Circuit breaker for each API method: after `failure_threshold` failures in a row calls of method
+    fail fast during `reset_seconds`, then one trial call is allowed, and it's success closes circuit
+    '''
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened = {}
+
+    def allow(self, key):
+        if not self.failure_threshold:
+            return True
+        with self.lock:
+            opened = self.opened.get(key)
+            if opened is None:
+                return True
+            if time.time() - opened >= self.reset_seconds:
+                # half-open: one trial call, others fail fast until it's result
+                self.opened[key] = time.time()
+                return True
+            return False
+
+    def success(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+            self.opened.pop(key, None)
+
+    def failure(self, key):
+        if not self.failure_threshold:
+            return
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if self.failures[key] >= self.failure_threshold:
+                self.opened[key] = time.time()
+
+
+class LatencyTracker(object):
+
+    '''
+    Keep durations of the last `size` calls of each method for calculation of percentiles
+    '''
+    def __init__(self, size=100, min_samples=20):
+        self.size = size
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def register(self, key, duration):
+        with self.lock:
+            if key not in self.durations:
+                self.durations[key] = deque(maxlen=self.size)
+            self.durations[key].append(duration)
+
+    def percentile(self, key, percent):
+        '''
+        Return percentile of durations or None, if there are not enough samples
+        '''
+        with self.lock:
+            durations = sorted(self.durations.get(key, []))
+        if len(durations) < self.min_samples:
+            return None
+        return durations[min(len(durations) - 1, int(len(durations) * percent / 100.))]
+
+
+def hedged_call(func, delay, hedge_func=None):
+    '''
+    Call `func` in thread and, if it doesn't return during `delay` seconds, call it (or `hedge_func`)
+    once more in parallel. Return the first successful result or raise the last error
+    '''
+    results = Queue()
+
+    def call(func):
+        try:
+            results.put((True, func()))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    def start(func):
+        thread = threading.Thread(target=call, args=(func,))
+        thread.daemon = True
+        thread.start()
+
+    start(func)
+    try:
+        success, result = results.get(timeout=delay)
+        calls_left = 0
+    except Empty:
+        start(hedge_func or func)
+        success, result = results.get()
+        calls_left = 1
+
+    if not success and calls_left:
+        success, result = results.get()
+    if success:
+        return result
+    raise result[0], result[1], result[2]
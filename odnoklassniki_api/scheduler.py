@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import get_models
+from django.utils import timezone
+
+from .instance_cache import invalidate_instances
+from .utils import list_chunks_iterator
+
+log = logging.getLogger('odnoklassniki_api')
+
+# priorities of API calls: interactive, usual and background ones
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+
+ACCESS_KEY = 'odnoklassniki_api.access.%s.%s'
+ACCESS_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def get_access_key(model, pk):
+    return ACCESS_KEY % (model._meta.db_table, pk)
+
+
+def register_access(instance):
+    '''
+    Count access to instance for prioritizing it's refreshing by RefreshScheduler.
+    Works only with setting ODNOKLASSNIKI_API_TRACK_ACCESS = True
+    '''
+    register_accesses(instance.__class__, [instance.pk])
+
+
+def register_accesses(model, pks):
+    '''
+    Count access to instances of model by pks, the same as register_access()
+    '''
+    if not getattr(settings, 'ODNOKLASSNIKI_API_TRACK_ACCESS', False):
+        return
+    for pk in pks:
+        if pk is None:
+            continue
+        key = get_access_key(model, pk)
+        if not cache.add(key, 1, ACCESS_TIMEOUT):
+            try:
+                cache.incr(key)
+            except ValueError:
+                pass
+
+
+class RateLimiter(object):
+
+    '''
+    Limit number of calls per second, shared between threads
+    '''
+    def __init__(self, calls_per_second=None):
+        self.interval = 1. / calls_per_second if calls_per_second else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PriorityRateLimiter(RateLimiter):
+
+    '''
+    Limit number of calls per second, shared between threads and classes of priority.
+    Call waits while calls of higher priority are waiting, and background calls use only
+    `1 - reserved_share` of budget, so the rest is reserved for interactive calls
+    '''
+    def __init__(self, calls_per_second=None, reserved_share=0.2):
+        super(PriorityRateLimiter, self).__init__(calls_per_second)
+        self.low_interval = self.interval / (1 - reserved_share) if self.interval else 0
+        self.next_low_call = 0
+        self.waiting = [0, 0, 0]
+        self.condition = threading.Condition(self.lock)
+
+    def reserve(self, now, priority):
+        '''
+        Take the slot of call with `priority`, called under lock
+        '''
+        self.next_call = now + self.interval
+        if priority == PRIORITY_LOW:
+            self.next_low_call = now + self.low_interval
+
+    def wait(self, priority=PRIORITY_NORMAL):
+        if not self.interval:
+            return
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.time()
+                    if sum(self.waiting[:priority]):
+                        # preempted by calls of higher priority
+                        self.condition.wait(self.interval)
+                        continue
+                    ready_at = max(self.next_call, self.next_low_call if priority == PRIORITY_LOW else 0)
+                    if ready_at <= now:
+                        self.reserve(now, priority)
+                        return
+                    self.condition.wait(ready_at - now)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+
+_priority = threading.local()
+
+
+def get_api_priority():
+    '''
+    Return priority of API calls of current thread
+    '''
+    priority = getattr(_priority, 'value', None)
+    return PRIORITY_NORMAL if priority is None else priority
+
+
+@contextmanager
+def api_priority(priority, force=True):
+    '''
+    Set priority of API calls of current thread inside block.
+    If `force` is False, priority is not changed, if it was already set by outer block
+    '''
+    previous = getattr(_priority, 'value', None)
+    if force or previous is None:
+        _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+_budget = threading.local()
+
+
+def get_api_budget():
+    '''
+    Return additional rate limiter of API calls of current thread or None
+    '''
+    return getattr(_budget, 'value', None)
+
+
+@contextmanager
+def api_budget(rate_limiter):
+    '''
+    Charge `rate_limiter` for each API call of current thread inside block in addition to budget of process
+    '''
+    previous = get_api_budget()
+    _budget.value = rate_limiter
+    try:
+        yield
+    finally:
+        _budget.value = previous
+
+
+class RefreshScheduler(object):
+
+    '''
+    Refresh stale objects of Odnoklassniki models off the request path.
+    Objects with `fetched` older than `timeout_days` are ordered by age multiplied by number of accesses,
+    grouped in batches of `batch_size` ids and refreshed with respect to `calls_per_second` API budget
+    '''
+    def __init__(self, models=None, timeout_days=1, batch_size=100, limit=1000, calls_per_second=None):
+        self.models = models or self.get_models()
+        self.timeout_days = timeout_days
+        self.batch_size = batch_size
+        self.limit = limit
+        self.rate_limiter = RateLimiter(
+            calls_per_second or getattr(settings, 'ODNOKLASSNIKI_API_REFRESH_CALLS_PER_SECOND', None))
+
+    def get_models(self):
+        from .models import OdnoklassnikiModel
+        return [model for model in get_models()
+                if issubclass(model, OdnoklassnikiModel) and hasattr(model, 'remote')]
+
+    def get_stale(self, model):
+        '''
+        Return list of (pk, fetched) of the most stale objects of model, never fetched ones first.
+        NULLs are sorted last on PostgreSQL and first on other databases, so they are selected separately
+        '''
+        expired_at = timezone.now() - timedelta(self.timeout_days)
+        stale = list(model.objects.filter(fetched__isnull=True).values_list('pk', 'fetched')[:self.limit])
+        if len(stale) < self.limit:
+            stale += list(model.objects.filter(fetched__lt=expired_at).order_by('fetched')
+                          .values_list('pk', 'fetched')[:self.limit - len(stale)])
+        return stale
+
+    def prioritize(self, model, stale):
+        '''
+        Return list of pks ordered by priority of refreshing
+        '''
+        now = timezone.now()
+        keys = dict([(get_access_key(model, pk), pk) for pk, fetched in stale])
+        accesses = dict([(keys[key], count) for key, count in cache.get_many(keys.keys()).items()])
+
+        def priority(item):
+            pk, fetched = item
+            age = (now - fetched).total_seconds() if fetched else float('inf')
+            return age * (1 + accesses.get(pk, 0))
+
+        return [pk for pk, fetched in sorted(stale, key=priority, reverse=True)]
+
+    def refresh_batch(self, model, ids):
+        '''
+        Refresh objects with `calls_per_second` budget charged for each API call,
+        objects of failed batch are refreshed one by one. Return number of refreshed objects,
+        failed objects and objects, that were not returned by API, are postponed
+        '''
+        # without microseconds, that are truncated by some databases
+        started = timezone.now().replace(microsecond=0)
+        instances = list(model.objects.filter(pk__in=ids))
+        with api_priority(PRIORITY_LOW, force=False), api_budget(self.rate_limiter):
+            try:
+                model.remote.refresh_many(instances)
+            except Exception, e:
+                log.error("Error while refreshing %s with pks %s: %s" % (model.__name__, ids, e))
+                for instance in instances:
+                    try:
+                        instance.refresh()
+                    except Exception, e:
+                        log.error("Error while refreshing %s with pk %s: %s" % (model.__name__, instance.pk, e))
+
+        refreshed = set(model.objects.filter(pk__in=ids, fetched__gte=started).values_list('pk', flat=True))
+        failed = [instance.pk for instance in instances if instance.pk not in refreshed]
+        if failed:
+            log.warning("%d objects of %s are not refreshed and postponed, pks: %s" %
+                        (len(failed), model.__name__, failed))
+            self.postpone(model, failed)
+        return len(refreshed)
+
+    def postpone(self, model, pks):
+        '''
+        Mark objects as fetched now, so they are not selected again until they become stale
+        '''
+        model.objects.filter(pk__in=pks).update(fetched=timezone.now())
+        invalidate_instances(model, pks)
+
+    def run_once(self):
+        '''
+        Refresh one portion of stale objects of each model, return number of refreshed objects
+        '''
+        count = 0
+        for model in self.models:
+            stale = self.get_stale(model)
+            if not stale:
+                continue
+            log.info("Refreshing %d stale objects of %s" % (len(stale), model.__name__))
+            for ids in list_chunks_iterator(self.prioritize(model, stale), self.batch_size):
+                count += self.refresh_batch(model, ids)
+        return count
+
+    def run(self, interval=60):
+        '''
+        Worker loop, sleep `interval` seconds if there is nothing to refresh
+        '''
+        while True:
+            if not self.run_once():
+                time.sleep(interval)
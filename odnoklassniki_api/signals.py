@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# sent by decorator `fetch_by_chunks_of` after each fetched chunk of ids
+chunk_fetched = Signal(providing_args=['items_limit', 'chunk_size', 'duration'])
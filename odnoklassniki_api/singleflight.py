@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import copy
+import hashlib
+import sys
+import threading
+import time
+
+from django.core.cache import cache
+
+__all__ = ['SingleFlight', 'CacheSingleFlight']
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+
+    '''
+    Coalesce concurrent calls with the same key in process: the first call is executed,
+    others wait for it and receive copy of it's result or it's exception
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args, **kwargs):
+        return self.do_until(key, None, func, *args, **kwargs)
+
+    def do_until(self, key, until, func, *args, **kwargs):
+        '''
+        The same as do(), but waiting for the first call lasts till `until` time at most,
+        after that `func` is called without coalescing
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            if not flight.event.wait(None if until is None else max(until - time.time(), 0)):
+                return func(*args, **kwargs)
+            if flight.exc_info:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+
+class CacheSingleFlight(SingleFlight):
+
+    '''
+    Coalesce concurrent calls with the same key in processes, that share Django cache.
+    The process, that acquires lock in cache, executes call and puts result to cache for `result_timeout` seconds,
+    others poll cache for result during `wait_timeout` seconds and execute call by themselves if it fails
+    '''
+    lock_key = 'odnoklassniki_api.singleflight.lock.%s'
+    result_key = 'odnoklassniki_api.singleflight.result.%s'
+
+    def __init__(self, wait_timeout=30, result_timeout=5, poll_interval=0.05):
+        super(CacheSingleFlight, self).__init__()
+        self.wait_timeout = wait_timeout
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+
+    def do_until(self, key, until, func, *args, **kwargs):
+        return super(CacheSingleFlight, self).do_until(key, until, self.do_in_cache, key, until, func, *args, **kwargs)
+
+    def do_in_cache(self, key, until, func, *args, **kwargs):
+        key = hashlib.md5(key).hexdigest()
+        lock_key = self.lock_key % key
+        result_key = self.result_key % key
+
+        if cache.add(lock_key, 1, self.wait_timeout):
+            try:
+                result = func(*args, **kwargs)
+                cache.set(result_key, result, self.result_timeout)
+                return result
+            finally:
+                cache.delete(lock_key)
+
+        deadline = min(time.time() + self.wait_timeout, until or float('inf'))
+        while time.time() < deadline:
+            # result is set before releasing lock, so check lock first
+            locked = cache.get(lock_key) is not None
+            result = cache.get(result_key)
+            if result is not None:
+                return result
+            if not locked:
+                break
+            time.sleep(self.poll_interval)
+
+        return func(*args, **kwargs)
@@ -1,13 +1,149 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+import random
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from django.test import TestCase, TransactionTestCase
 from django.conf import settings
+from django.core.cache import cache
+from django.contrib import admin
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
 from social_api.api import override_api_context
 import mock
 
-from .api import api_call, OdnoklassnikiApi
+from . import fields
+from .admin import EstimatedCountPaginator, FastChangeListMixin, GenericRelationListFilter
+from .api import (api_call, OdnoklassnikiApi, OdnoklassnikiCircuitOpenError, OdnoklassnikiDeadlineError,
+                  OdnoklassnikiError)
+from .archive import ResponseArchive
+from .exceptions import OdnoklassnikiContentError
+from .decorators import AdaptiveChunkSize, atomic, fetch_by_chunks_of
+from .expiry import ExpirationPlanner
+from .graph import EmbeddedObjectsGraph
+from .instance_cache import LocMemInstanceCache, commit_cached
+from .models import (FetchJob, OdnoklassnikiManager, OdnoklassnikiModel, OdnoklassnikiPKModel,
+                     OdnoklassnikiTimelineManager)
+from .partitions import TimelinePartitions
+from .resilience import CircuitBreaker, LatencyTracker, fail_on_overload, hedged_call
+from .scheduler import (PRIORITY_HIGH, PRIORITY_LOW, PriorityRateLimiter, RefreshScheduler, api_priority,
+                        get_access_key, register_access)
+from .singleflight import SingleFlight
+from .transport import get_session
+from .workqueue import WorkQueue
 
 GROUP_ID = 53038939046008
 
+
+class Group(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    remote_pk_field = 'uid'
+
+    name = models.CharField(max_length=100)
+    members_count = models.IntegerField(null=True)
+
+    remote = OdnoklassnikiManager(methods={'get': 'getInfo'})
+
+
+class TopicRemoteManager(OdnoklassnikiManager):
+
+    @fetch_by_chunks_of(2)
+    def fetch_texts(self, ids, text):
+        if 5 in ids:
+            raise OdnoklassnikiError({'code': 2, 'text': 'SERVICE : Service is temporary unavailable',
+                                      'method': 'topics.getTexts', 'params': {}})
+        return [self.model.objects.create(id=id, text=text) for id in ids]
+
+
+class Topic(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    owner = models.ForeignKey(Group, null=True)
+    text = models.TextField()
+    created = models.DateTimeField(null=True)
+
+    remote = TopicRemoteManager(methods={'get': 'getByIds'})
+
+
+class Author(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    remote_pk_field = 'uid'
+
+    name = models.CharField(max_length=100)
+
+    remote = OdnoklassnikiManager(methods={'get': 'getInfo'}, instance_cache=LocMemInstanceCache(10))
+
+
+class Label(OdnoklassnikiModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    remote_pk_field = 'code'
+
+    code = models.CharField(max_length=10, unique=True)
+
+    remote = OdnoklassnikiManager(remote_pk=('code',))
+
+
+class Section(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    label = models.ForeignKey(Label, null=True)
+    parent = models.ForeignKey('self', null=True)
+
+
+class Post(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    author = models.ForeignKey(Author, null=True)
+
+    tags = fields.MultiValueField(base_field=models.CharField(max_length=50))
+    ref_ids = fields.MultiValueField(base_field=models.BigIntegerField())
+
+    remote = OdnoklassnikiManager(methods={'get': 'getByIds'})
+
+
+class Note(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    text = models.TextField()
+    date = models.DateTimeField(null=True)
+
+    remote = OdnoklassnikiTimelineManager(methods={'get': 'getByIds'}, partition_interval='month')
+
+
+class Comment(OdnoklassnikiPKModel):
+
+    class Meta:
+        app_label = 'odnoklassniki_api'
+
+    owner_content_type = models.ForeignKey(ContentType)
+    owner_id = models.BigIntegerField()
+    owner = generic.GenericForeignKey('owner_content_type', 'owner_id')
+
 TOKEN = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', {'odnoklassniki': {'token': None}})['odnoklassniki']['token']
 
 
@@ -23,9 +159,998 @@ class OdnoklassnikiApiTest(TestCase):
             response = api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok')
         self.assertEqual(response, {u'objectId': GROUP_ID, u'type': u'GROUP'})
 
-    @mock.patch('odnoklassniki.api.Odnoklassniki._request', side_effect=lambda *args, **kwargs: (200, {u'error_data': None, u'error_code': 102, u'error_msg': u'PARAM_SESSION_EXPIRED : Session expired'}))
+    @mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=lambda *args, **kwargs: (200, {u'error_data': None, u'error_code': 102, u'error_msg': u'PARAM_SESSION_EXPIRED : Session expired'}))
     @mock.patch('odnoklassniki_api.api.OdnoklassnikiApi.handle_error_code_102')
     def test_error_102(self, request, handle_error):
 
         api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok')
         self.assertTrue(handle_error.called)
+
+    def test_api_threads(self):
+
+        def request(method, **kwargs):
+            time.sleep(random.random() / 1000)
+            return 200, {'method': method}
+
+        def call(name, errors):
+            for i in range(20):
+                method = '%s.%d' % (name, i)
+                response = api_call(method)
+                if response != {'method': method}:
+                    errors += [(method, response)]
+
+        errors = []
+        with mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=request):
+            with override_api_context('odnoklassniki', token='token'):
+                threads = [threading.Thread(target=call, args=('thread%d' % i, errors)) for i in range(10)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_api_coalesce_calls(self):
+
+        def request(method, **kwargs):
+            time.sleep(0.2)
+            return 200, {u'objectId': GROUP_ID, u'type': u'GROUP'}
+
+        def call(responses):
+            responses += [api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok')]
+
+        responses = []
+        with mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=request) as _request:
+            with override_api_context('odnoklassniki', token='token'):
+                threads = [threading.Thread(target=call, args=(responses,)) for i in range(5)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        self.assertEqual(_request.call_count, 1)
+        self.assertEqual(responses, [{u'objectId': GROUP_ID, u'type': u'GROUP'}] * 5)
+
+        # calls of different priority are not coalesced
+        def call_with_priority(priority):
+            with api_priority(priority):
+                call(responses)
+
+        with mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=request) as _request:
+            with override_api_context('odnoklassniki', token='token'):
+                threads = [threading.Thread(target=call_with_priority, args=(priority,))
+                           for priority in [PRIORITY_LOW, PRIORITY_HIGH]]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        self.assertEqual(_request.call_count, 2)
+
+        # calls with different deadline or failing on overload are not coalesced
+        from .api import get_call_key
+        self.assertNotEqual(get_call_key('url.getInfo', {}), get_call_key('url.getInfo', {}, 10))
+        with fail_on_overload():
+            key = get_call_key('url.getInfo', {})
+        self.assertNotEqual(get_call_key('url.getInfo', {}), key)
+
+    def test_single_flight_deadline(self):
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait()
+            return 'leader'
+
+        flight = SingleFlight()
+        thread = threading.Thread(target=flight.do, args=('key', slow))
+        thread.start()
+        started.wait()
+        try:
+            # follower calls by itself after deadline
+            self.assertEqual(flight.do_until('key', time.time() + 0.05, lambda: 'follower'), 'follower')
+        finally:
+            release.set()
+            thread.join()
+
+    def test_api_call_priority(self):
+
+        def request(method, **kwargs):
+            return 200, {u'objectId': GROUP_ID, u'type': u'GROUP'}
+
+        with mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=request):
+            with mock.patch('odnoklassniki_api.api.get_rate_limiter') as get_rate_limiter:
+                with override_api_context('odnoklassniki', token='token'):
+                    with api_priority(PRIORITY_LOW):
+                        api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok', priority=PRIORITY_HIGH)
+                        api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok', coalesce=False)
+
+        self.assertEqual(get_rate_limiter.return_value.wait.call_args_list,
+                         [mock.call(PRIORITY_HIGH), mock.call(PRIORITY_LOW)])
+
+    @mock.patch('odnoklassniki_api.transport.Odnoklassniki._request',
+                side_effect=lambda *args, **kwargs: (200, {u'error_code': 2, u'error_msg': u'SERVICE'}))
+    def test_api_call_deadline(self, request):
+
+        with override_api_context('odnoklassniki', token='token'):
+            with mock.patch('odnoklassniki_api.api._circuit_breaker', CircuitBreaker(None)):
+                # the first repeat after error is out of deadline
+                self.assertRaises(OdnoklassnikiDeadlineError, api_call, 'group.getInfo', uids=1, deadline=0.5)
+                self.assertEqual(request.call_count, 1)
+
+                # call is repeated once after 1 second with timeout of request limited by deadline
+                self.assertRaises(OdnoklassnikiDeadlineError, api_call, 'group.getInfo', uids=1, deadline=1.2)
+                self.assertEqual(request.call_count, 3)
+                self.assertLessEqual(request.call_args[1]['timeout'][1], 0.2)
+
+    @mock.patch('social_api.api.time.sleep')
+    @mock.patch('odnoklassniki_api.transport.Odnoklassniki._request',
+                side_effect=lambda *args, **kwargs: (200, {u'error_code': 2, u'error_msg': u'SERVICE'}))
+    def test_api_call_circuit_breaker(self, request, sleep):
+
+        with override_api_context('odnoklassniki', token='token'):
+            with mock.patch('odnoklassniki_api.api._circuit_breaker', CircuitBreaker(2, 60)):
+                self.assertRaises(OdnoklassnikiCircuitOpenError, api_call, 'group.getInfo', uids=1)
+                self.assertEqual(request.call_count, 2)
+
+                # calls fail fast without requests
+                self.assertRaises(OdnoklassnikiCircuitOpenError, api_call, 'group.getInfo', uids=2)
+                self.assertEqual(request.call_count, 2)
+
+    def test_hedged_call(self):
+
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+
+        started = time.time()
+        self.assertEqual(hedged_call(func, 0.1), 'fast')
+        self.assertLess(time.time() - started, 0.5)
+
+        del calls[:]
+        hedges = []
+        self.assertEqual(hedged_call(func, 0.1, lambda: hedges.append(1) or func()), 'fast')
+        self.assertEqual(hedges, [1])
+
+        tracker = LatencyTracker(min_samples=10)
+        for duration in range(1, 11):
+            tracker.register('group.getInfo', duration)
+        self.assertEqual(tracker.percentile('group.getInfo', 90), 10)
+        self.assertEqual(tracker.percentile('users.getInfo', 90), None)
+
+    def test_transport_shared_session(self):
+
+        session = get_session()
+        self.assertEqual(id(session), id(get_session()))
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+
+        with mock.patch.object(session, 'post') as post:
+            post.return_value.status_code = 200
+            post.return_value.json.return_value = {u'objectId': GROUP_ID, u'type': u'GROUP'}
+            with override_api_context('odnoklassniki', token='token'):
+                response = api_call('url.getInfo', url='http://www.odnoklassniki.ru/apiok')
+
+        self.assertEqual(response, {u'objectId': GROUP_ID, u'type': u'GROUP'})
+        self.assertEqual(post.call_args[1]['data']['access_token'], 'token')
+
+
+class OdnoklassnikiManagerTest(TestCase):
+
+    def test_refresh_many(self):
+
+        class Instance(object):
+            def __init__(self, pk, name='', **refresh_kwargs):
+                self.pk = pk
+                self.name = name
+                self.refresh_kwargs = refresh_kwargs
+                self.refresh = mock.Mock()
+
+        instances = [Instance(1, ids=[1]), Instance(2, ids=[2]), Instance(3, ids=[3], fields='name'),
+                     Instance(4, id=4)]
+        manager = OdnoklassnikiManager()
+        manager.model = mock.Mock()
+        with mock.patch.object(manager, 'fetch_one',
+                               side_effect=lambda ids, **kw: [Instance(id, name='new') for id in ids]) as fetch_one:
+            manager.refresh_many(instances)
+
+        self.assertEqual(sorted(fetch_one.call_args_list), [mock.call(ids=[1, 2]), mock.call(fields='name', ids=[3])])
+        self.assertEqual([instance.name for instance in instances], ['new', 'new', 'new', ''])
+        self.assertTrue(instances[3].refresh.called)
+        self.assertFalse(instances[0].refresh.called)
+
+    def test_parse_response_records(self):
+
+        response = [{'uid': '1', 'name': 'Group 1', 'members_count': '10'}, [{'uid': 2, 'name': 'Group 2'}], 3]
+        records = list(Group.remote.parse_response_records(response, extra_fields={'fetched': None, 'extra': 1}))
+
+        self.assertEqual(len(records), 2)
+        self.assertFalse(hasattr(records[0], '__dict__'))
+
+        instance = records[0].to_instance()
+        self.assertIsInstance(instance, Group)
+        self.assertEqual(instance.pk, 1)
+        self.assertEqual(instance.name, 'Group 1')
+        self.assertEqual(instance.members_count, 10)
+        self.assertEqual(instance.extra, 1)
+        self.assertEqual(records[1].to_instance().members_count, None)
+
+    def test_parse_response_list_parallel(self):
+
+        group = Group.objects.create(id=1, name='Group')
+        response = [{'id': str(i), 'owner': '1' if i % 2 else '5', 'text': 'Topic %d' % i,
+                     'created': '2015-01-0%d 10:00:00' % i} for i in range(1, 6)]
+
+        with self.assertNumQueries(1):
+            instances = Topic.remote.parse_response_list_parallel(response, processes=2, chunksize=2)
+
+        self.assertEqual([instance.pk for instance in instances], [1, 2, 3, 4, 5])
+        self.assertEqual(instances[0].owner, group)
+        self.assertEqual(instances[1].owner_id, '5')
+        self.assertEqual(instances[2].created, instances[2].parse_values({'created': '2015-01-03 10:00:00'})['created'])
+        self.assertEqual(instances[4].text, 'Topic 5')
+
+        # pool is shared between calls
+        from .parallel import _inherited_connections, get_pool, reset_connections
+        self.assertIs(get_pool(2), get_pool(2))
+
+        # inherited connection is forgotten, but not deallocated
+        connection = mock.Mock()
+        with mock.patch('odnoklassniki_api.parallel.connections') as connections:
+            connections.all.return_value = [connection]
+            inherited = connection.connection
+            reset_connections()
+        self.assertIsNone(connection.connection)
+        self.assertIs(_inherited_connections.pop(), inherited)
+
+    def test_skip_unchanged_resources(self):
+
+        response = [{'uid': 1, 'name': 'Group 1'}, {'uid': 2, 'name': 'Group 2'}]
+        Group.remote.skip_unchanged = True
+        try:
+            Group.remote.save_response(response, {'fetched': timezone.now() - timedelta(1)})
+
+            response[1]['name'] = 'Group 2 renamed'
+            fetched = timezone.now()
+            with mock.patch.object(Group, 'parse', autospec=True, side_effect=Group.parse) as parse:
+                Group.remote.save_response(response, {'fetched': fetched})
+        finally:
+            Group.remote.skip_unchanged = False
+
+        # only changed resource is parsed, but both objects are fetched
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(Group.objects.get(pk=2).name, 'Group 2 renamed')
+        self.assertEqual(list(Group.objects.filter(fetched=fetched).values_list('pk', flat=True).order_by('pk')), [1, 2])
+
+        # all resources are parsed again after changing of parsing
+        Group.remote.skip_unchanged = True
+        try:
+            with mock.patch.object(Group, 'parse_version', 2), \
+                    mock.patch.object(Group, 'parse', autospec=True, side_effect=Group.parse) as parse:
+                Group.remote.save_response(response, {'fetched': fetched})
+        finally:
+            Group.remote.skip_unchanged = False
+        self.assertEqual(parse.call_count, 2)
+
+    def test_resource_hash_of_saved_resource(self):
+
+        Group.objects.create(id=1, name='Group 1', resource_hash='old')
+        Group.remote.skip_unchanged = True
+        try:
+            Group.remote.get_or_create_from_resource({'uid': 1, 'name': 'Group 1 renamed'})
+        finally:
+            Group.remote.skip_unchanged = False
+        self.assertEqual(Group.objects.get(pk=1).resource_hash,
+                         Group.remote.calculate_resource_hash({'uid': 1, 'name': 'Group 1 renamed'}))
+
+    def test_resource_hash_before_parse(self):
+
+        resource = {'uid': 1, 'name': 'Group 1'}
+        self.assertEqual(Group.remote.parse_response_dict(dict(resource)).resource_hash, '')
+
+        def parse(instance, response):
+            response.pop('name')
+            instance.name = 'Group'
+
+        Group.remote.skip_unchanged = True
+        try:
+            with mock.patch.object(Group, 'parse', autospec=True, side_effect=parse):
+                instance = Group.remote.parse_response_dict(dict(resource))
+        finally:
+            Group.remote.skip_unchanged = False
+        # hash of raw resource is the same, as hash checked for unchanged resources
+        self.assertEqual(instance.resource_hash, Group.remote.calculate_resource_hash(resource))
+
+    def test_save_embedded_objects(self):
+
+        Group.objects.create(id=1, name='Group 1',
+                             resource_hash=Group.remote.calculate_resource_hash({'uid': 1, 'name': 'Group 1'}))
+        Group.objects.create(id=2, name='Group 2', members_count=10)
+        response = [
+            {'id': 1, 'text': 'Topic 1', 'owner': {'uid': 1, 'name': 'Group 1'}},
+            {'id': 2, 'text': 'Topic 2', 'owner': {'uid': 2, 'name': 'Group 2 renamed'}},
+            {'id': 3, 'text': 'Topic 3', 'owner': {'uid': 3, 'name': 'Group 3'}},
+            {'id': 4, 'text': 'Topic 4', 'owner': {'uid': 3, 'name': 'Group 3'}},
+        ]
+        Group.remote.skip_unchanged = True
+        try:
+            topics = Topic.remote.parse_response_list(response)
+        finally:
+            Group.remote.skip_unchanged = False
+
+        # select stored, create new, update fetched of unchanged and save changed group
+        with self.assertNumQueries(4):
+            EmbeddedObjectsGraph().add_many(topics).save()
+
+        Topic.remote.get_or_create_from_instances_list(topics)
+        self.assertEqual(Group.objects.count(), 3)
+        self.assertEqual(Group.objects.get(pk=2).name, 'Group 2 renamed')
+        self.assertEqual(Group.objects.get(pk=2).members_count, 10)
+        self.assertEqual(dict(Topic.objects.values_list('pk', 'owner_id')), {1: 1, 2: 2, 3: 3, 4: 3})
+        self.assertIs(topics[2].owner, topics[3].owner)
+
+    def test_save_embedded_objects_without_pk(self):
+
+        label = Label(code='news')
+        label._embedded = True
+        child = Section(id=2, label=label)
+        child._embedded = True
+        parent = Section(id=1, parent=child)
+
+        EmbeddedObjectsGraph().add_many([parent]).save()
+        parent.save()
+
+        # link to embedded object without pk is set before saving of object, that refers it
+        self.assertEqual(Section.objects.get(pk=2).label_id, Label.objects.get(code='news').pk)
+        self.assertEqual(Section.objects.get(pk=1).parent_id, 2)
+
+    def test_multi_value_field(self):
+
+        Post.remote.save_response([
+            {'id': 1, 'tags': 'news,sport', 'ref_ids': ['10', '20']},
+            {'id': 2, 'tags': ['news'], 'ref_ids': [20]},
+            {'id': 3, 'tags': [], 'ref_ids': '30'},
+        ])
+        post = Post.objects.get(pk=1)
+        self.assertEqual(post.tags, [u'news', u'sport'])
+        self.assertEqual(post.ref_ids, [10, 20])
+
+        def pks(**kwargs):
+            return sorted(Post.objects.filter(**kwargs).values_list('pk', flat=True))
+
+        self.assertEqual(pks(tags__has='news'), [1, 2])
+        self.assertEqual(pks(tags__has_all=['news', 'sport']), [1])
+        self.assertEqual(pks(ref_ids__has_any=[10, 30]), [1, 3])
+        self.assertEqual(pks(ref_ids__has_any=[]), [])
+
+        # side table is updated after changing of values
+        values_model = Post._meta.get_field('tags').values_model
+        sport = values_model.objects.get(owner=post, value='sport')
+        post.tags = ['music', 'sport']
+        post.save()
+        self.assertEqual(pks(tags__has='news'), [2])
+        self.assertEqual(pks(tags__has='music'), [1])
+        self.assertTrue(values_model.objects.filter(pk=sport.pk).exists())
+
+        # unchanged values are not rewritten: update of post and select of values of each field
+        with self.assertNumQueries(3):
+            post.save()
+
+    def test_get_request_fields(self):
+
+        manager = OdnoklassnikiManager()
+        manager.fields = {'group': ['uid', 'name', 'shortname', 'name'], 'user': ['uid']}
+        manager.model = mock.Mock(remote_pk_field='uid', remote_pk_local_field='id')
+        manager.model._meta.fields = [mock.Mock(attname='id'), mock.Mock(attname='name')]
+        manager.model._meta.fields[0].name = 'id'
+        manager.model._meta.fields[1].name = 'name'
+
+        self.assertEqual(manager.get_request_fields('group'), 'uid,name,shortname')
+        self.assertEqual(manager.get_request_fields('group', 'user', prefix=True),
+                         'group.uid,group.name,group.shortname,user.uid')
+        self.assertEqual(manager.get_request_fields('group', model_fields=True), 'uid,name')
+
+        # projections are memoized
+        manager.fields = {}
+        self.assertEqual(manager.get_request_fields('group'), 'uid,name,shortname')
+
+
+class InstanceCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        Author.remote.instance_cache.items.clear()
+
+    def test_instance_cache(self):
+
+        author = Author.remote.get_or_create_from_resource({'uid': 1, 'name': 'Author'})
+
+        # instance is cached after saving
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.remote.get_instance(1).name, 'Author')
+            post = Post.remote.parse_response_dict({'id': 1, 'author': '1'})
+        self.assertEqual(post.author.pk, author.pk)
+
+        # stored instance is read from DB, not from cache: select and transaction of update
+        with self.assertNumQueries(3):
+            Author.remote.get_or_create_from_resource({'uid': 1, 'name': 'Author renamed'})
+        self.assertEqual(Author.remote.get_instance(1).name, 'Author renamed')
+
+        # changes of rolled back transaction are not cached
+        try:
+            with atomic():
+                Author.remote.get_or_create_from_resource({'uid': 1, 'name': 'Author rolled back'})
+                raise ValueError
+        except ValueError:
+            pass
+        with self.assertNumQueries(1):
+            self.assertEqual(Author.remote.get_instance(1).name, 'Author renamed')
+
+        # changes are cached after commit
+        commit_cached(atomic(Author.remote.get_or_create_from_resource))({'uid': 1, 'name': 'Author committed'})
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.remote.get_instance(1).name, 'Author committed')
+
+        Author.objects.get(pk=1).delete()
+        self.assertRaises(Author.DoesNotExist, Author.remote.get_instance, 1)
+
+
+class DecoratorsTest(TestCase):
+
+    def test_fetch_by_chunks_of_adaptive(self):
+
+        class Manager(object):
+            model = mock.Mock()
+            sizes = []
+
+            @fetch_by_chunks_of(100, adaptive=True, min_items_limit=10)
+            def fetch(self, ids):
+                self.sizes += [len(ids)]
+                if len(self.sizes) == 1:
+                    raise OdnoklassnikiError({'code': 2, 'text': 'SERVICE', 'method': '', 'params': {}})
+
+        manager = Manager()
+        with mock.patch('odnoklassniki_api.decorators.time') as time:
+            time.time.side_effect = [0, 0, 20, 0, 1, 0, 1, 0, 1, 0, 1]
+            manager.fetch(ids=range(250))
+
+        # failed chunk is fetched again with halved size, slow one halves and fast ones double it
+        self.assertEqual(manager.sizes, [100, 50, 25, 50, 100, 25])
+
+    def test_fetch_by_chunks_of_adaptive_failures_in_row(self):
+
+        class Manager(object):
+            model = mock.Mock()
+            chunks = []
+
+            @fetch_by_chunks_of(4, adaptive=True, min_items_limit=1)
+            def fetch(self, ids):
+                self.chunks += [ids]
+                if len(self.chunks) <= 2:
+                    raise OdnoklassnikiError({'code': 2, 'text': 'SERVICE', 'method': '', 'params': {}})
+                return [mock.Mock(pk=id) for id in ids]
+
+        Manager().fetch(ids=range(1, 9))
+        # all ids of failed chunks are requested again
+        self.assertEqual(Manager.chunks[:3], [[1, 2, 3, 4], [1, 2], [1]])
+        self.assertEqual(sorted(sum(Manager.chunks[2:], [])), range(1, 9))
+        Manager.model.objects.filter.assert_called_once_with(pk__in=set(range(1, 9)))
+
+    def test_fetch_by_chunks_of_result(self):
+
+        class Manager(object):
+            model = mock.Mock()
+
+            @fetch_by_chunks_of(2)
+            def fetch(self, ids):
+                # one object of each chunk is not saved
+                return [mock.Mock(pk=id) for id in ids[:1]]
+
+        Manager().fetch(ids=[1, 2, 3, 4, 5])
+        Manager.model.objects.filter.assert_called_once_with(pk__in=set([1, 3, 5]))
+
+        # too many pks are not selected by one condition IN
+        Manager.model.reset_mock()
+        with mock.patch('odnoklassniki_api.decorators.FETCHED_PKS_LIMIT', 2):
+            Manager().fetch(ids=[1, 2, 3, 4, 5])
+        kwargs = Manager.model.objects.filter.call_args[1]
+        self.assertEqual(sorted(kwargs), ['fetched__gte', 'pk__gte', 'pk__lte'])
+        self.assertEqual((kwargs['pk__gte'], kwargs['pk__lte']), (1, 5))
+
+    def test_fetch_by_chunks_of_duplicated_ids(self):
+
+        class Manager(object):
+            model = mock.Mock()
+            chunks = []
+
+            @fetch_by_chunks_of(2)
+            def fetch(self, ids):
+                self.chunks += [ids]
+
+        Manager().fetch(ids=[3, 1, 3, 2, 1])
+        self.assertEqual(Manager.chunks, [[1, 2], [3]])
+
+    def test_fetch_by_chunks_of_lazy_ids(self):
+
+        class Manager(object):
+            model = mock.Mock()
+            chunks = []
+
+            @fetch_by_chunks_of(2)
+            def fetch(self, ids):
+                self.chunks += [ids]
+                return [mock.Mock(pk=id) for id in ids]
+
+        # ids of generator are consumed chunk by chunk, number of saved objects is returned
+        self.assertEqual(Manager().fetch(ids=(id for id in [3, 3, 1, 2, 2])), 4)
+        self.assertEqual(Manager.chunks, [[3], [1, 2], [2]])
+        self.assertFalse(Manager.model.objects.filter.called)
+
+        for id in [1, 2, 3]:
+            Group.objects.create(id=id, name='Group')
+        Manager.chunks = []
+        self.assertEqual(Manager().fetch(ids=Group.objects.order_by('pk')), 3)
+        self.assertEqual(Manager.chunks, [[1, 2], [3]])
+
+    def test_fetch_by_chunks_of_batch_window(self):
+
+        class Manager(object):
+            model = mock.Mock(remote_pk_local_field='id')
+            chunks = []
+
+            @fetch_by_chunks_of(10, batch_window=0.2)
+            def fetch(self, ids):
+                self.chunks += [ids]
+                return [mock.Mock(pk=id) for id in ids]
+
+        Manager.model._meta.pk.name = 'id'
+        threads = [threading.Thread(target=Manager().fetch, kwargs={'ids': ids}) for ids in [[1, 2], [3, 2]]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(Manager.chunks, [[1, 2, 3]])
+        self.assertItemsEqual(Manager.model.objects.filter.call_args_list,
+                              [mock.call(pk__in=set([1, 2])), mock.call(pk__in=set([2, 3]))])
+
+    def test_fetch_by_chunks_of_adaptive_arguments(self):
+
+        self.assertRaises(TypeError, fetch_by_chunks_of(100, min_items_limit=10), lambda self, ids: ids)
+
+    @mock.patch('odnoklassniki_api.transport.Odnoklassniki._request',
+                side_effect=lambda *args, **kwargs: (200, {u'error_code': 2, u'error_msg': u'SERVICE'}))
+    def test_fail_on_overload(self, request):
+
+        with override_api_context('odnoklassniki', token='token'):
+            with mock.patch('odnoklassniki_api.api._circuit_breaker', CircuitBreaker(None)):
+                # error of overloaded server is raised to decorator without repeating of call
+                with fail_on_overload():
+                    self.assertRaises(OdnoklassnikiError, api_call, 'group.getInfo', uids=1)
+        self.assertEqual(request.call_count, 1)
+
+        chunk_size = AdaptiveChunkSize(100)
+        self.assertTrue(chunk_size.can_shrink(OdnoklassnikiError({'code': 2, 'text': '', 'method': '', 'params': {}})))
+        self.assertFalse(chunk_size.can_shrink(OdnoklassnikiCircuitOpenError(
+            {'code': None, 'text': '', 'method': '', 'params': {}})))
+        self.assertFalse(chunk_size.can_shrink(OdnoklassnikiDeadlineError(
+            {'code': None, 'text': '', 'method': '', 'params': {}})))
+
+    def test_adaptive_chunk_size(self):
+
+        chunk_size = AdaptiveChunkSize(100, min_items_limit=20, slow_seconds=10, fast_seconds=2)
+        self.assertEqual(chunk_size.size, 100)
+        chunk_size.register(20)
+        chunk_size.register(20)
+        chunk_size.register(20)
+        self.assertEqual(chunk_size.size, 20)
+        chunk_size.register(5)
+        self.assertEqual(chunk_size.size, 20)
+        chunk_size.register(1)
+        chunk_size.register(1)
+        chunk_size.register(1)
+        self.assertEqual(chunk_size.size, 100)
+
+    def test_expiration_planner_cache(self):
+
+        planner = ExpirationPlanner(timeout_days=1, batch_size=2, cache_size=2)
+        planner.register_fetched('model', [1, 2, 3])
+
+        with mock.patch.object(planner, 'get_non_expired_ids', side_effect=lambda model, ids, expired_at: ids[:1]) \
+                as get_non_expired_ids:
+            ids_expired, ids_non_expired = planner.split('model', [1, 2, 3, 4, 5, 5, 6])
+
+        # id 1 is pushed out of the cache, others are checked in DB by batches
+        self.assertEqual(get_non_expired_ids.call_count, 2)
+        self.assertEqual(ids_non_expired, set([1, 2, 3, 5]))
+        self.assertEqual(ids_expired, [4, 6])
+
+
+class RefreshSchedulerTest(TestCase):
+
+    def test_priority_rate_limiter(self):
+
+        calls = []
+
+        class Limiter(PriorityRateLimiter):
+            def reserve(self, now, priority):
+                super(Limiter, self).reserve(now, priority)
+                calls.append(priority)
+
+        def wait_until(condition):
+            for i in range(5000):
+                if condition():
+                    return
+                time.sleep(0.001)
+            self.fail('Condition is not reached')
+
+        clock = [1000.]
+        with mock.patch('odnoklassniki_api.scheduler.time') as scheduler_time:
+            scheduler_time.time.side_effect = lambda: clock[0]
+            limiter = Limiter(20)
+            limiter.wait()
+            del calls[:]
+
+            # background calls wait for the interactive one, even if it comes later
+            threads = [threading.Thread(target=limiter.wait, args=(PRIORITY_LOW,)) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            wait_until(lambda: limiter.waiting[PRIORITY_LOW] == 3)
+            threads += [threading.Thread(target=limiter.wait, args=(PRIORITY_HIGH,))]
+            threads[-1].start()
+            wait_until(lambda: limiter.waiting[PRIORITY_HIGH] == 1)
+
+            # time goes on only when all calls are waiting
+            while any([thread.is_alive() for thread in threads]):
+                with limiter.condition:
+                    clock[0] += 1
+                    limiter.condition.notify_all()
+                time.sleep(0.001)
+
+        self.assertEqual(calls, [PRIORITY_HIGH] + [PRIORITY_LOW] * 3)
+
+    def test_refresh_batch(self):
+
+        for id in [1, 2, 3]:
+            Group.objects.create(id=id, name='Group %d' % id)
+
+        def request(method, **kwargs):
+            return 200, {u'objectId': GROUP_ID, u'type': u'GROUP'}
+
+        def refresh(instance):
+            if instance.pk == 2:
+                raise OdnoklassnikiError({'code': 100, 'text': 'PARAM', 'method': '', 'params': {}})
+            api_call('url.getInfo', url='http://www.odnoklassniki.ru/%d' % instance.pk, coalesce=False)
+            Group.objects.filter(pk=instance.pk).update(fetched=timezone.now())
+
+        scheduler = RefreshScheduler(models=[Group])
+        scheduler.rate_limiter = mock.Mock()
+        with mock.patch('odnoklassniki_api.transport.Odnoklassniki._request', side_effect=request), \
+                mock.patch.object(Group.remote, 'refresh_many', side_effect=ValueError), \
+                mock.patch.object(Group, 'refresh', autospec=True, side_effect=refresh), \
+                override_api_context('odnoklassniki', token='token'):
+            # objects of failed batch are refreshed one by one
+            self.assertEqual(scheduler.refresh_batch(Group, [1, 2, 3]), 2)
+
+        # budget of scheduler is charged for each API call
+        self.assertEqual(scheduler.rate_limiter.wait.call_count, 2)
+        # failed object is postponed
+        self.assertEqual(scheduler.get_stale(Group), [])
+
+        # objects, that were not returned by API, are not counted and postponed
+        Group.objects.update(fetched=None)
+        with mock.patch.object(Group.remote, 'refresh_many'):
+            self.assertEqual(scheduler.refresh_batch(Group, [1, 2, 3]), 0)
+        self.assertEqual(scheduler.get_stale(Group), [])
+
+    def test_get_stale(self):
+
+        now = timezone.now()
+        for id, fetched in [(1, now - timedelta(3)), (2, None), (3, now - timedelta(2)), (4, now)]:
+            Group.objects.create(id=id, name='Group %d' % id, fetched=fetched)
+
+        # never fetched objects are not starved by limit
+        self.assertEqual([pk for pk, fetched in RefreshScheduler(models=[Group], limit=2).get_stale(Group)], [2, 1])
+        self.assertEqual([pk for pk, fetched in RefreshScheduler(models=[Group]).get_stale(Group)], [2, 1, 3])
+
+    @mock.patch('odnoklassniki_api.scheduler.settings.ODNOKLASSNIKI_API_TRACK_ACCESS', True, create=True)
+    def test_register_access(self):
+
+        Group.objects.create(id=1, name='Group 1')
+        Group.remote.get_instance(1)
+        Group.remote.get_instances([1])
+        self.assertEqual(cache.get(get_access_key(Group, 1)), 2)
+
+    @mock.patch('odnoklassniki_api.scheduler.settings.ODNOKLASSNIKI_API_TRACK_ACCESS', True, create=True)
+    def test_prioritize(self):
+
+        model = mock.Mock()
+        model._meta.db_table = 'table'
+        for i in range(3):
+            register_access(mock.Mock(__class__=model, pk=2))
+
+        now = timezone.now()
+        stale = [(1, now - timedelta(2)), (2, now - timedelta(1)), (3, None), (4, now - timedelta(3))]
+        # never fetched first, then the oldest, often accessed object is older than less accessed ones
+        self.assertEqual(RefreshScheduler(models=[model]).prioritize(model, stale), [3, 2, 4, 1])
+
+
+class ResponseArchiveTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_and_replay(self):
+
+        archive = ResponseArchive(self.path)
+        archive.append(Group, 'get', {'uids': [1, 2]}, [{'uid': 1, 'name': 'Group 1'}, {'uid': 2, 'name': 'Group 2'}])
+        archive.append(Group, 'get', {'uids': [1]}, [{'uid': 1, 'name': 'Group 1 renamed'}])
+
+        entries = list(archive)
+        self.assertEqual([entry['kwargs'] for entry in entries], [{'uids': [1, 2]}, {'uids': [1]}])
+        self.assertEqual(archive.read(entries[1]['offset'], entries[1]['length']),
+                         [{'uid': 1, 'name': 'Group 1 renamed'}])
+
+        self.assertEqual(archive.replay(models=[Group]), 2)
+        self.assertEqual(Group.objects.count(), 2)
+        self.assertEqual(Group.objects.get(pk=1).name, 'Group 1 renamed')
+        self.assertIsNotNone(Group.objects.get(pk=2).fetched)
+
+    def test_replay_extra_fields(self):
+
+        group = Group.objects.create(id=1, name='Group')
+        archive = ResponseArchive(self.path)
+        archive.append(Topic, 'get', {'ids': [1]}, [{'id': 1, 'text': 'Topic'}],
+                       extra_fields={'owner_id': 1, 'group': group, 'fetched': timezone.now()})
+
+        entry = list(archive)[0]
+        self.assertEqual(entry['extra_fields'], {'owner_id': 1, 'group': {'__model__': 'odnoklassniki_api.Group',
+                                                                          'pk': 1}})
+        self.assertEqual(archive.load_extra_fields(entry['extra_fields']), {'owner_id': 1, 'group': group})
+
+        self.assertEqual(archive.replay(models=[Topic]), 1)
+        self.assertEqual(Topic.objects.get(pk=1).owner, group)
+
+    def test_empty_response_is_not_archived(self):
+
+        with self.settings(ODNOKLASSNIKI_API_ARCHIVE_PATH=self.path), \
+                mock.patch.object(Group.remote, 'api_call', return_value={}):
+            self.assertRaises(OdnoklassnikiContentError, Group.remote.get, 'get', uids=[1])
+        self.assertEqual(list(ResponseArchive(self.path)), [])
+
+
+class WorkQueueTest(TestCase):
+
+    def test_queue_jobs(self):
+
+        self.assertEqual(Topic.remote.fetch_texts(ids=[3, 1, 2, 4, 5, 1], text='Topic', queue='topics'), 3)
+        progress = WorkQueue('topics').progress()
+        self.assertEqual(progress['jobs'], {'pending': 3})
+        self.assertEqual(progress['ids'], {'pending': 5})
+
+        # failed job is repeated once more
+        self.assertEqual(WorkQueue('topics', max_attempts=2, retry_seconds=0).work(), 4)
+        self.assertItemsEqual(Topic.objects.values_list('pk', flat=True), [1, 2, 3, 4])
+
+        job = FetchJob.objects.get(status=FetchJob.FAILED)
+        self.assertEqual(job.ids, [5])
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('SERVICE : Service is temporary unavailable', job.error)
+
+        progress = WorkQueue('topics').progress()
+        self.assertEqual(progress['jobs'], {'done': 2, 'failed': 1})
+        self.assertEqual(progress['fetched'], 4)
+        self.assertEqual(progress['percent'], 100)
+
+    def test_queue_lease(self):
+
+        Topic.remote.fetch_texts(ids=[1, 2], text='Topic', queue='topics')
+
+        job = WorkQueue('topics', lease_seconds=60, worker='first').claim()
+        self.assertEqual(job.worker, 'first')
+        self.assertEqual(WorkQueue('topics', worker='second').claim(), None)
+
+        # job of crashed worker is claimed by another one after expiration of lease
+        FetchJob.objects.update(lease_until=timezone.now() - timedelta(seconds=1))
+        job = WorkQueue('topics', worker='second').claim()
+        self.assertEqual((job.worker, job.attempts, job.ids), ('second', 2, [1, 2]))
+
+
+class AdminTest(TestCase):
+
+    def test_generic_relation_list_filter_lookups(self):
+
+        class OwnerListFilter(GenericRelationListFilter):
+            title = 'owner'
+            ct_field_name = 'owner_content_type'
+            id_field_name = 'owner_id'
+            field_name = 'owner'
+
+        groups = [Group.objects.create(id=i, name='Group %d' % i) for i in range(1, 4)]
+        topic = Topic.objects.create(id=1, text='Topic')
+        for i, owner in enumerate(groups + groups + [topic]):
+            Comment.objects.create(id=i, owner=owner)
+
+        group_ct = ContentType.objects.get_for_model(Group)
+        topic_ct = ContentType.objects.get_for_model(Topic)
+
+        # distinct pairs and one query for objects of each content type
+        with self.assertNumQueries(3):
+            lookups = OwnerListFilter(None, {}, Comment, mock.Mock(model=Comment)).lookup_choices
+
+        self.assertItemsEqual(lookups, [('%s-%s' % (group_ct.pk, group.pk), unicode(group)) for group in groups] +
+                              [('%s-1' % topic_ct.pk, unicode(topic))])
+
+    def test_fast_changelist_keyset_pagination(self):
+        for i in range(1, 8):
+            Topic.objects.create(id=i, text='Topic %d' % i)
+
+        paginator = EstimatedCountPaginator(Topic.objects.order_by('-pk'), 3)
+        self.assertEqual(paginator.count, 7)
+        self.assertEqual([topic.pk for topic in paginator.page(1).object_list], [7, 6, 5])
+
+        # next page is selected by the last key of the previous one, not by offset
+        Topic.objects.filter(pk=4).delete()
+        self.assertEqual([topic.pk for topic in paginator.page(2).object_list], [3, 2, 1])
+
+        self.assertEqual(EstimatedCountPaginator(Topic.objects.order_by('-id'), 3).get_keyset_fields(), ['-pk'])
+        self.assertIsNone(EstimatedCountPaginator(Topic.objects.order_by('owner_id'), 3).get_keyset_fields())
+        # keys of pages are not shared by queries with different filters
+        self.assertNotEqual(paginator.get_keyset_cache_key(['-pk'], 1), EstimatedCountPaginator(
+            Topic.objects.filter(text='Topic 1').order_by('-pk'), 3).get_keyset_cache_key(['-pk'], 1))
+
+    def test_fast_changelist_deferred_fields(self):
+
+        class TopicAdmin(FastChangeListMixin, admin.ModelAdmin):
+            list_display = ('id', 'created')
+
+        Topic.objects.create(id=1, text='Topic')
+        model_admin = TopicAdmin(Topic, admin.site)
+        request = mock.Mock(odnoklassniki_changelist=True)
+
+        topic = model_admin.get_queryset(request).get()
+        self.assertNotIn('text', topic.__dict__)
+        self.assertEqual(model_admin.get_list_deferred_fields(request), ['text'])
+
+
+class PartitionsTest(TestCase):
+
+    def test_partition_intervals(self):
+
+        self.assertRaises(ValueError, TimelinePartitions, Note, 'date', 'hour')
+        value = datetime(2016, 12, 31, 23, 0, tzinfo=timezone.utc)
+        for interval, start, next_start, name in [
+            ('day', date(2016, 12, 31), date(2017, 1, 1), 'odnoklassniki_api_note_p20161231'),
+            ('week', date(2016, 12, 26), date(2017, 1, 2), 'odnoklassniki_api_note_p20161226'),
+            ('month', date(2016, 12, 1), date(2017, 1, 1), 'odnoklassniki_api_note_p201612'),
+            ('year', date(2016, 1, 1), date(2017, 1, 1), 'odnoklassniki_api_note_p2016'),
+        ]:
+            partitions = TimelinePartitions(Note, 'date', interval)
+            self.assertEqual(partitions.get_start(value), start)
+            self.assertEqual(partitions.get_next_start(start), next_start)
+            self.assertEqual(partitions.get_partition_name(start), name)
+
+    def test_create_and_detach_partitions(self):
+
+        partitions = Note.remote.get_partitions()
+        with mock.patch.object(partitions, 'execute') as execute:
+            names = partitions.create_partitions(ahead=2)
+        # partition of current month and 2 upcoming ones
+        self.assertEqual(names, [partitions.get_partition_name(start) for start in [
+            partitions.get_start(timezone.now()), partitions.get_next_start(partitions.get_start(timezone.now())),
+            partitions.get_next_start(partitions.get_next_start(partitions.get_start(timezone.now())))]])
+        sql, params = execute.call_args[0]
+        self.assertIn('PARTITION OF "odnoklassniki_api_note" FOR VALUES FROM', sql)
+        self.assertEqual(params[1], partitions.get_bound(partitions.get_next_start(params[0].date())))
+
+        with mock.patch.object(partitions, 'get_partitions', return_value=[
+                ('odnoklassniki_api_note_p201601', date(2016, 1, 1)),
+                ('odnoklassniki_api_note_p201602', date(2016, 2, 1))]), \
+                mock.patch.object(partitions, 'execute') as execute:
+            self.assertEqual(partitions.detach_partitions(datetime(2016, 2, 10, tzinfo=timezone.utc), schema='archive'),
+                             ['odnoklassniki_api_note_p201601'])
+        self.assertEqual([call[0][0] for call in execute.call_args_list], [
+            'ALTER TABLE "odnoklassniki_api_note" DETACH PARTITION "odnoklassniki_api_note_p201601"',
+            'CREATE SCHEMA IF NOT EXISTS "archive"',
+            'ALTER TABLE "odnoklassniki_api_note_p201601" SET SCHEMA "archive"',
+        ])
+
+    def test_setup(self):
+
+        partitions = Note.remote.get_partitions()
+        statements = []
+
+        def execute(sql, params=None):
+            statements.append(sql)
+            cursor = mock.Mock()
+            if 'pg_partitioned_table' in sql:
+                cursor.fetchone.return_value = None
+            elif 'pg_get_serial_sequence' in sql:
+                cursor.fetchone.return_value = ('"public"."odnoklassniki_api_note_id_seq"',)
+            elif 'min(' in sql:
+                cursor.fetchone.return_value = (timezone.now(),)
+            return cursor
+
+        with mock.patch.object(partitions, 'execute', side_effect=execute):
+            self.assertTrue(partitions.setup(ahead=1))
+
+        self.assertEqual(statements[:3], [
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+            'ALTER TABLE "odnoklassniki_api_note" RENAME TO "odnoklassniki_api_note_unpartitioned"',
+            'CREATE TABLE "odnoklassniki_api_note" (LIKE "odnoklassniki_api_note_unpartitioned" INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE ("date")',
+        ])
+        self.assertIn('ALTER SEQUENCE "public"."odnoklassniki_api_note_id_seq" OWNED BY "odnoklassniki_api_note"."id"',
+                      statements)
+        self.assertIn('CREATE UNIQUE INDEX "odnoklassniki_api_note_pk_date" ON "odnoklassniki_api_note" ("id", "date")',
+                      statements)
+        self.assertIn('CREATE TABLE "odnoklassniki_api_note_default" PARTITION OF "odnoklassniki_api_note" DEFAULT',
+                      statements)
+        # partition of current month and the next one
+        self.assertEqual(len([sql for sql in statements if 'FOR VALUES FROM' in sql]), 2)
+        self.assertEqual(statements[-2:], [
+            'INSERT INTO "odnoklassniki_api_note" SELECT * FROM "odnoklassniki_api_note_unpartitioned"',
+            'DROP TABLE "odnoklassniki_api_note_unpartitioned"',
+        ])
+
+        with mock.patch.object(Note._meta, 'unique_together', [('text', 'date')]):
+            self.assertRaises(ValueError, partitions.get_indexed_columns)
+
+    def test_queries_routed_to_partition(self):
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        created = timezone.now() - timedelta(10)
+        Note.objects.create(id=1, text='Note', date=created)
+
+        with CaptureQueriesContext(connection) as queries:
+            Note.remote.get_or_create_from_instance(Note(id=1, text='Changed', date=created))
+        self.assertEqual(Note.objects.get(pk=1).text, 'Changed')
+        # stored object is selected and updated by pk and date of partition
+        self.assertEqual(len(queries), 2)
+        for query in queries:
+            self.assertIn('"odnoklassniki_api_note"."date"', query['sql'])
+
+        # object with another date is found in any partition instead of creating duplicate
+        Note.remote.get_or_create_from_instance(Note(id=1, text='Moved', date=created + timedelta(1)))
+        self.assertEqual(list(Note.objects.values_list('pk', 'text', 'date')), [(1, 'Moved', created + timedelta(1))])
+        Note.objects.filter(pk=1).update(date=created)
+
+        self.assertEqual(Note.remote.get_timeline_queryset(after=created - timedelta(1)).count(), 1)
+        self.assertEqual(Note.remote.get_timeline_queryset(after=created - timedelta(2),
+                                                           before=created - timedelta(1)).count(), 0)
+
+
+class ImportTest(TestCase):
+
+    heavy_modules = ['requests', 'odnoklassniki', 'social_api.api', 'simplejson', 'multiprocessing',
+                     'odnoklassniki_api.api', 'odnoklassniki_api.fields_api']
+
+    def test_import_models_is_lazy(self):
+        script = '\n'.join([
+            'import sys',
+            'from django.conf import settings',
+            'settings.configure(INSTALLED_APPS=("django.contrib.contenttypes",), SOCIAL_API_TOKENS_STORAGES=[])',
+            'import django',
+            'django.setup()',
+            'from odnoklassniki_api.models import *',
+            'print ",".join([name for name in %r if name in sys.modules])' % self.heavy_modules,
+            'print COMMIT_REMOTE, MASTER_DATABASE, OdnoklassnikiModel.__name__, OdnoklassnikiManager.__name__',
+        ])
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        output = subprocess.check_output([sys.executable, '-c', script], env=env).splitlines()
+
+        # API client, network stack and tables of fields are loaded on first use only
+        self.assertEqual(output[0], '')
+        # public names and constants of previous versions are still importable by star import
+        self.assertEqual(output[1], 'True default OdnoklassnikiModel OdnoklassnikiManager')
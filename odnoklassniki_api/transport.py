@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import requests
+from django.conf import settings
+from odnoklassniki import api, OdnoklassnikiError
+from requests.adapters import HTTPAdapter
+
+__all__ = ['Odnoklassniki', 'get_session']
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''
+    Return HTTP session with pool of keep-alive connections, shared between all threads of process.
+    Settings:
+     * ODNOKLASSNIKI_API_POOL_SIZE - max number of connections kept in pool;
+     * ODNOKLASSNIKI_API_GZIP - ask server to compress responses.
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=getattr(settings, 'ODNOKLASSNIKI_API_POOL_SIZE', 10))
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Accept': 'application/json',
+                    'Accept-Encoding': 'gzip, deflate' if getattr(settings, 'ODNOKLASSNIKI_API_GZIP', True)
+                    else 'identity',
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                })
+                _session = session
+    return _session
+
+
+def get_timeout():
+    '''
+    Return tuple of connect and read timeouts from settings
+    ODNOKLASSNIKI_API_CONNECT_TIMEOUT and ODNOKLASSNIKI_API_TIMEOUT
+    '''
+    return (getattr(settings, 'ODNOKLASSNIKI_API_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'ODNOKLASSNIKI_API_TIMEOUT', api.DEFAULT_TIMEOUT))
+
+
+class Odnoklassniki(api.Odnoklassniki):
+
+    '''
+    Odnoklassniki API client, that sends requests through the shared pool of keep-alive connections
+    '''
+    def _request(self, method, timeout=None, **kwargs):
+        params = {
+            'application_key': self.application_key,
+            'format': self.data_format,
+            'method': method,
+        }
+        params.update(kwargs)
+        params['sig'] = self._signature(params)
+        if self.token:
+            params['access_token'] = self.token
+
+        try:
+            response = get_session().post(api.API_URL, data=params, timeout=timeout or get_timeout())
+            return response.status_code, response.json()
+        except requests.exceptions.RequestException:
+            raise OdnoklassnikiError({
+                'code': None,
+                'text': 'HTTP error',
+                'method': method,
+                'params': params,
+            })
@@ -1,4 +1,10 @@
+import hashlib
+import uuid
+from itertools import islice
+
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models.query import QuerySet, ValuesListQuerySet
 
 
 def get_improperly_configured_field(app_name, decorate_property=False):
@@ -7,3 +13,65 @@ def get_improperly_configured_field(app_name, decorate_property=False):
     if decorate_property:
         field = property(field)
     return field
+
+
+def list_chunks_iterator(l, n):
+    """ Yield successive n-sized chunks from l. Iterators, generators and querysets are consumed lazily.
+    """
+    if isinstance(l, (list, tuple)):
+        for i in xrange(0, len(l), n):
+            yield l[i:i+n]
+    else:
+        iterator = iter_values(l, n)
+        while True:
+            chunk = list(islice(iterator, n))
+            if not chunk:
+                break
+            yield chunk
+
+
+def is_lazy_iterable(values):
+    """ Return True for iterators, generators and querysets, that should be consumed lazily.
+    """
+    return hasattr(values, '__iter__') and not isinstance(values, (list, tuple, set, frozenset, dict))
+
+
+def iter_values(values, chunk_size=1000):
+    """ Iterate over values of any iterable. Queryset of instances is iterated as pks, queryset of values lists
+    as values of the first column, on PostgreSQL through server-side cursor, that fetches `chunk_size` rows at once.
+    """
+    if not isinstance(values, QuerySet):
+        return iter(values)
+    if isinstance(values, ValuesListQuerySet) and not values.flat:
+        values = values.values_list(values._fields[0], flat=True)
+    elif not isinstance(values, ValuesListQuerySet):
+        values = values.values_list('pk', flat=True)
+
+    connection = connections[values.db]
+    if connection.vendor != 'postgresql':
+        return values.iterator()
+    return iter_server_side_cursor(connection, values, chunk_size)
+
+
+def iter_server_side_cursor(connection, queryset, chunk_size):
+    sql, params = queryset.query.sql_with_params()
+    connection.ensure_connection()
+    # cursor WITH HOLD lives outside of transaction, so values could be saved while iterating
+    cursor = connection.connection.cursor(name='odnoklassniki_api_%s' % uuid.uuid4().hex, withhold=True)
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row[0]
+    finally:
+        cursor.close()
+
+
+def get_resource_hash(resource, extra_fields=None, schema=None):
+    """ Return md5 hash of resource from API response and extra fields, except time of fetching,
+    and `schema` - description of model and it's parsing.
+    """
+    import simplejson as json
+
+    data = [resource, dict([(k, v) for k, v in (extra_fields or {}).items() if k != 'fetched']), schema]
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=lambda o: getattr(o, 'pk', unicode(o)))).hexdigest()
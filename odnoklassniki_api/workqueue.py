@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.db import connections, router
+from django.db.models import Count, F, Q, Sum, get_model
+from django.utils import timezone
+
+from .decorators import atomic
+from .scheduler import PRIORITY_LOW, api_priority
+from .utils import list_chunks_iterator
+
+__all__ = ['WorkQueue']
+
+log = logging.getLogger('odnoklassniki_api')
+
+
+def get_worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+
+    '''
+    Queue of fetching jobs in DB table, shared by any number of worker processes on any nodes.
+    Job is claimed by worker for `lease_seconds`, job of crashed worker is claimed by another one
+    after expiration of lease. Failed job is repeated after `retry_seconds` multiplied by number of attempts,
+    until number of attempts reaches `max_attempts`.
+    On PostgreSQL 9.5+ jobs are claimed by SELECT ... FOR UPDATE SKIP LOCKED, on other databases
+    and older versions of PostgreSQL by conditional UPDATE of candidate job.
+    '''
+    batch_size = 1000
+
+    def __init__(self, name='default', lease_seconds=300, max_attempts=3, retry_seconds=60, worker=None):
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.worker = worker or get_worker_name()
+
+    @property
+    def model(self):
+        from .models import FetchJob
+        return FetchJob
+
+    @property
+    def db(self):
+        return router.db_for_write(self.model)
+
+    def enqueue(self, manager, method, ids, chunk_size, ids_argument='ids', kwargs=None):
+        '''
+        Split ids on chunks and put jobs for fetching them by method of manager. Return number of jobs.
+        Ids could be passed as any iterable or queryset, jobs are created by batches of `batch_size`
+        '''
+        model = manager.model
+        jobs = []
+        jobs_count = ids_count = 0
+        for chunk in list_chunks_iterator(ids, chunk_size):
+            jobs += [self.model(queue=self.name, model='%s.%s' % (model._meta.app_label, model._meta.object_name),
+                                manager=getattr(manager, 'name', 'remote'), method=method, ids_argument=ids_argument,
+                                ids=list(chunk), ids_count=len(chunk), kwargs=kwargs or {})]
+            ids_count += len(chunk)
+            if len(jobs) >= self.batch_size:
+                self.model.objects.using(self.db).bulk_create(jobs)
+                jobs_count += len(jobs)
+                jobs = []
+        if jobs:
+            self.model.objects.using(self.db).bulk_create(jobs)
+            jobs_count += len(jobs)
+        log.debug("Put %d jobs for fetching %d ids by %s.%s() into queue %s" %
+                  (jobs_count, ids_count, model.__name__, method, self.name))
+        return jobs_count
+
+    def get_claimable(self, now):
+        return self.model.objects.using(self.db).filter(queue=self.name).filter(
+            Q(status=self.model.PENDING) & (Q(lease_until__isnull=True) | Q(lease_until__lte=now)) |
+            Q(status=self.model.RUNNING, lease_until__lt=now, attempts__lt=self.max_attempts))
+
+    def expire(self, now):
+        '''
+        Mark jobs, that exceeded attempts in crashed workers, as failed
+        '''
+        self.model.objects.using(self.db).filter(queue=self.name, status=self.model.RUNNING, lease_until__lt=now,
+                                                 attempts__gte=self.max_attempts) \
+            .update(status=self.model.FAILED, error='Lease expired')
+
+    def claim(self):
+        '''
+        Take the next job for execution or return None if there is no job
+        '''
+        now = timezone.now()
+        self.expire(now)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql' and self.get_pg_version(connection) >= 90500:
+            return self.claim_skip_locked(now)
+
+        for pk in self.get_claimable(now).order_by('pk').values_list('pk', flat=True)[:10]:
+            # job was claimed by another worker, if it's not updated
+            if self.get_claimable(now).filter(pk=pk).update(**self.get_claim_values(now)):
+                return self.model.objects.using(self.db).get(pk=pk)
+        return None
+
+    def get_pg_version(self, connection):
+        # version is known after connecting, conditional UPDATE is used if it's unknown
+        connection.cursor()
+        return getattr(connection, 'pg_version', None) or 0
+
+    def claim_skip_locked(self, now):
+        queryset = self.get_claimable(now).order_by('pk').values('pk')[:1]
+        sql, params = queryset.query.sql_with_params()
+        with atomic(using=self.db):
+            cursor = connections[self.db].cursor()
+            cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            self.model.objects.using(self.db).filter(pk=row[0]).update(**self.get_claim_values(now))
+        return self.model.objects.using(self.db).get(pk=row[0])
+
+    def get_claim_values(self, now):
+        return {
+            'status': self.model.RUNNING,
+            'lease_until': now + timedelta(seconds=self.lease_seconds),
+            'worker': self.worker,
+            'attempts': F('attempts') + 1,
+            'updated': now,
+        }
+
+    def execute(self, job):
+        '''
+        Fetch ids of job, mark job as done or schedule it's repeating after error
+        '''
+        model = get_model(*job.model.split('.'))
+        method = getattr(getattr(model, job.manager), job.method)
+        kwargs = dict(job.kwargs)
+        kwargs[job.ids_argument] = job.ids
+        try:
+            with api_priority(PRIORITY_LOW, force=False):
+                result = method(**kwargs)
+            job.fetched_count = result.count() if hasattr(result, 'count') else len(result or [])
+            job.status = self.model.DONE
+            job.error = ''
+        except Exception, e:
+            log.error("Error while executing job %s of queue %s: %s" % (job.pk, self.name, e))
+            job.error = unicode(e)
+            if job.attempts >= self.max_attempts:
+                job.status = self.model.FAILED
+            else:
+                job.status = self.model.PENDING
+                job.lease_until = timezone.now() + timedelta(seconds=self.retry_seconds * job.attempts)
+        job.save(using=self.db, update_fields=['fetched_count', 'status', 'error', 'lease_until', 'updated'])
+        return job.status == self.model.DONE
+
+    def work(self, limit=None):
+        '''
+        Execute jobs until queue is empty or `limit` of jobs is reached, return number of executed jobs
+        '''
+        count = 0
+        while limit is None or count < limit:
+            job = self.claim()
+            if job is None:
+                break
+            self.execute(job)
+            count += 1
+        return count
+
+    def run(self, interval=10):
+        '''
+        Worker loop, sleep `interval` seconds if queue is empty
+        '''
+        while True:
+            if not self.work():
+                time.sleep(interval)
+
+    def progress(self):
+        '''
+        Return dict with number of jobs and ids by status, number of fetched objects
+        and percent of finished ids
+        '''
+        progress = {'jobs': {}, 'ids': {}, 'fetched': 0, 'percent': 0}
+        for row in self.model.objects.using(self.db).filter(queue=self.name).values('status') \
+                .annotate(jobs=Count('pk'), ids=Sum('ids_count'), fetched=Sum('fetched_count')):
+            progress['jobs'][row['status']] = row['jobs']
+            progress['ids'][row['status']] = row['ids']
+            progress['fetched'] += row['fetched']
+
+        total = sum(progress['ids'].values())
+        if total:
+            finished = progress['ids'].get(self.model.DONE, 0) + progress['ids'].get(self.model.FAILED, 0)
+            progress['percent'] = 100. * finished / total
+        return progress
@@ -1 +1,2 @@
 INSTALLED_APPS = ()
+USE_TZ = True
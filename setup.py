@@ -19,6 +19,7 @@ setup(
         'django-picklefield',
         'django-social-api>=0.0.3',
         'odnoklassniki',
+        'requests',
         'simplejson',
         'pytz',
     ],